@@ -0,0 +1,319 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+###############################################################################
+# Copyright (c) 2011-2013 Vadim Shlyakhov
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a
+#  copy of this software and associated documentation files (the "Software"),
+#  to deal in the Software without restriction, including without limitation
+#  the rights to use, copy, modify, merge, publish, distribute, sublicense,
+#  and/or sell copies of the Software, and to permit persons to whom the
+#  Software is furnished to do so, subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included
+#  in all copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+#  OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+#  THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+#  FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+#  DEALINGS IN THE SOFTWARE.
+###############################################################################
+
+from __future__ import with_statement
+from __future__ import print_function
+import time
+import tempfile
+import Queue
+import optparse
+
+from tiler_functions import *
+import tiler
+
+fixture_lst = ['rgb', 'paletted', 'gcp', 'cutline']
+
+# fixture extent, long/lat
+fixture_box = (10.0, 54.0, 10.5, 54.3)
+
+#----------------------------
+
+def pattern_rows(n_bands):
+    '''a 256x256 pattern for each band;
+    bytes are shifted per 256x256 block, so neighbouring tiles differ'''
+#----------------------------
+    return [
+        [bytearray(((x + y) * (b + 1) ^ (x * y >> 6)) & 255 for x in range(256)) for y in range(256)]
+        for b in range(n_bands)]
+
+shift_tables = [bytearray((i + s) & 255 for i in range(256)) for s in range(256)]
+
+def write_pattern(ds, n_bands, solid=None):
+    'fill the bands with a pattern, the left quarter of the raster is a solid colour (an "ocean")'
+    width, height = ds.RasterXSize, ds.RasterYSize
+    patterns = pattern_rows(n_bands)
+    n_blocks = (width + 255) // 256
+    solid_width = width // 4
+    for b in range(n_bands):
+        band = ds.GetRasterBand(b + 1)
+        for y in range(height):
+            row = bytearray()
+            for bx in range(n_blocks):
+                shift = (bx * 37 + (y // 256) * 91) & 255
+                row += patterns[b][y % 256].translate(shift_tables[shift])
+            if solid is not None:
+                row[:solid_width] = chr(solid[b]) * solid_width
+            band.WriteRaster(0, y, width, 1, str(row[:width]))
+
+#----------------------------
+
+def make_fixture(kind, size, work_dir):
+    'create a synthetic source raster, returns its path'
+#----------------------------
+    path = os.path.join(work_dir, 'bench-%s-%d.tif' % (kind, size))
+    if os.path.exists(path):
+        return path
+    ld('make_fixture', path)
+
+    west, south, east, north = fixture_box
+    paletted = kind == 'paletted'
+    n_bands = 1 if paletted else 3
+    ds = gdal.GetDriverByName('GTiff').Create(path, size, size, n_bands, GDT_Byte, ['TILED=YES'])
+    wgs84 = txt2wkt('EPSG:4326')
+
+    if kind == 'gcp': # corners and the center
+        gcps = [gdal.GCP(lon, lat, 0, px, py) for lon, lat, px, py in (
+            (west, north, 0, 0),
+            (east, north, size, 0),
+            (east, south, size, size),
+            (west, south, 0, size),
+            ((west + east) / 2, (north + south) / 2, size / 2, size / 2),
+            )]
+        ds.SetGCPs(gcps, wgs84)
+    else:
+        ds.SetProjection(wgs84)
+        ds.SetGeoTransform((west, (east - west) / size, 0, north, 0, -(north - south) / size))
+
+    if kind == 'cutline': # a pixel coordinates polygon, as map2gdal produces
+        c = size / 8.
+        ds.SetMetadataItem('CUTLINE', 'MULTIPOLYGON(((%r %r,%r %r,%r %r,%r %r,%r %r)))' % (
+            c, c, size - c, 2 * c, size - 2 * c, size - c, 2 * c, size - 2 * c, c, c))
+
+    if paletted:
+        band = ds.GetRasterBand(1)
+        band.SetColorInterpretation(GCI_PaletteIndex)
+        color_table = gdal.ColorTable()
+        for i in range(256): # index 0 is transparent, so tiles are rendered in paletted mode
+            color_table.SetColorEntry(i, (i, 255 - i, (i * 7) & 255, 255 if i else 0))
+        band.SetColorTable(color_table)
+        write_pattern(ds, 1, solid=(17,))
+    else:
+        write_pattern(ds, 3, solid=(20, 60, 160))
+    ds = None
+    return path
+
+#----------------------------
+
+def run_case(case, queue):
+    'run a single case in a fresh process, so its peak RSS is its own'
+#----------------------------
+    try:
+        queue.put(tiler_case(case))
+    except Exception as exc:
+        queue.put({'error': repr(exc)})
+        raise
+
+#----------------------------
+
+def tiler_case(case):
+
+#----------------------------
+    argv = case['args'] + ['--profile', case['profile'], '--base-resampling', case['resampling'],
+        '--overview-resampling', case['overview_resampling'], '-t', case['dest_dir'], '-q', case['src']]
+    if case['profile'] == 'generic':
+        argv += ['--tiles-srs', 'EPSG:3857']
+    if case['fixture'] == 'cutline':
+        argv += ['--cut']
+    tiler.options, args = tiler.parse_args(argv)
+    tiler.options.n_workers = 1
+
+    src_ds = gdal.Open(case['src'], GA_ReadOnly) # the pyramid closes its source once warped
+    src_mpix = src_ds.RasterXSize * src_ds.RasterYSize / 1e6
+    del src_ds
+
+    prm = tiler.src_pyramid((case['src'], False))
+    start = time.time()
+    prm.generate_tiles()
+    elapsed = time.time() - start
+
+    zooms = prm.stats.data
+    n_tiles = sum(rec.get('tiles', 0) for rec in zooms.values())
+    n_bytes = sum(rec.get('bytes', 0) for rec in zooms.values())
+    rss = peak_rss()
+    return {
+        'seconds':      elapsed,
+        'tiles':        n_tiles,
+        'bytes':        n_bytes,
+        'tiles_per_s':  n_tiles / elapsed if elapsed else None,
+        'mb_per_s':     n_bytes / 1e6 / elapsed if elapsed else None,
+        'src_mpix_per_s': src_mpix / elapsed if elapsed else None,
+        'peak_rss_mb':  rss / 1024. if rss is not None else None,
+        'zooms':        dict((str(z), rec) for z, rec in zooms.items()),
+        'stages':       dict(('%s/%s' % (stage, '' if z is None else z), rec)
+                            for (stage, z), rec in prm.timing.data.items()),
+        }
+
+#----------------------------
+
+def case_result(proc, res_queue, poll=5):
+    'wait for the result of a case, an error if its process dies without one'
+#----------------------------
+    while True:
+        try:
+            return res_queue.get(timeout=poll)
+        except Queue.Empty:
+            if not proc.is_alive():
+                try: # the result may have been put just before the exit
+                    return res_queue.get(timeout=poll)
+                except Queue.Empty:
+                    return {'error': 'the case process exited with code %s' % proc.exitcode}
+
+#----------------------------
+
+def run_bench(options):
+
+#----------------------------
+    work_dir = options.work_dir or tempfile.mkdtemp(prefix='bench_tiler-')
+    if not os.path.isdir(work_dir):
+        os.makedirs(work_dir)
+    # options passed through to the tiler
+    tiler_args = ['--tile-format', options.tile_format, '--sink', options.sink]
+    if options.zoom:
+        tiler_args += ['--zoom', options.zoom]
+    if options.tiler_args:
+        tiler_args += options.tiler_args.split()
+
+    results = {}
+    for fixture in options.fixtures.split(','):
+        src = make_fixture(fixture, options.size, work_dir)
+        for profile in options.profiles.split(','):
+            for resampling in options.resampling.split(','):
+                key = '%s/%s/%s' % (fixture, profile, resampling)
+                case = {
+                    'fixture':      fixture,
+                    'profile':      profile,
+                    'resampling':   resampling,
+                    'overview_resampling': 'nearest' if resampling == 'nearest' else 'antialias',
+                    'src':          src,
+                    'dest_dir':     os.path.join(work_dir, 'out', key.replace('/', '-')),
+                    'args':         tiler_args,
+                    }
+                res_queue = multiprocessing.Queue()
+                proc = multiprocessing.Process(target=run_case, args=(case, res_queue))
+                proc.start()
+                res = case_result(proc, res_queue)
+                proc.join()
+                if options.keep is None:
+                    shutil.rmtree(case['dest_dir'], ignore_errors=True)
+                res['args'] = tiler_args
+                results[key] = res
+                if 'error' in res:
+                    logging.error('%s failed: %s' % (key, res['error']))
+                    continue
+                logging.info('%-32s %8d tiles %8.1f tiles/s %7.2f MB/s %8.1f MB RSS' % (
+                    key, res['tiles'], res['tiles_per_s'] or 0, res['mb_per_s'] or 0, res['peak_rss_mb'] or 0))
+
+    if options.work_dir is None and options.keep is None:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return {
+        'version':  version,
+        'size':     options.size,
+        'date':     time.strftime('%Y-%m-%d %H:%M:%S'),
+        'cases':    results,
+        }
+
+#----------------------------
+
+def compare(report, baseline, tolerance):
+    'cases slower than the baseline by more than the tolerance'
+#----------------------------
+    regressions = []
+    for key, res in sorted(report['cases'].items()):
+        base = baseline['cases'].get(key)
+        if not base or not base.get('tiles_per_s') or not res.get('tiles_per_s'):
+            continue
+        ratio = res['tiles_per_s'] / base['tiles_per_s']
+        res['baseline_ratio'] = ratio
+        regressed = ratio < 1 - tolerance
+        logging.info('%-32s %6.2fx baseline%s' % (key, ratio, ' REGRESSION' if regressed else ''))
+        if regressed:
+            regressions.append(key)
+    return regressions
+
+#----------------------------
+
+def main(argv):
+
+#----------------------------
+    parser = optparse.OptionParser(
+        usage="usage: %prog [<options>...]",
+        version=version,
+        description='Tiler benchmark on synthetic sources')
+    parser.add_option('--size', type='int', default=2048, metavar='PIXELS',
+        help='fixture raster size (default: 2048)')
+    parser.add_option('--fixtures', default=','.join(fixture_lst), metavar='LIST',
+        help='fixtures to run: %s (default: all)' % ', '.join(fixture_lst))
+    parser.add_option('--profiles', default='zyx,tms,tms-geo,generic', metavar='LIST',
+        help='tiler profiles (default: zyx,tms,tms-geo,generic)')
+    parser.add_option('--resampling', default='nearest,bilinear', metavar='LIST',
+        help='base resampling methods (default: nearest,bilinear)')
+    parser.add_option('-z', '--zoom', default=None, metavar='ZOOM_LIST',
+        help='zoom levels (default: auto)')
+    parser.add_option('--tile-format', default='png', metavar='FMT',
+        help='tile format (default: png)')
+    parser.add_option('--sink', default='dir', metavar='SINK',
+        help='tile sink (default: dir)')
+    parser.add_option('--tiler-args', default=None, metavar='"ARGS"',
+        help='extra tiler options')
+    parser.add_option('--work-dir', default=None, metavar='DIR',
+        help='fixtures and output directory, fixtures are reused (default: a temporary one)')
+    parser.add_option('--keep', action='store_true',
+        help='keep the generated tiles')
+    parser.add_option('-o', '--output', default=None, metavar='FILE',
+        help='write the JSON report to a file (default: stdout)')
+    parser.add_option('--baseline', default=None, metavar='FILE',
+        help='compare tiles/s against an earlier report')
+    parser.add_option('--tolerance', type='float', default=0.1, metavar='FRACTION',
+        help='slowdown against the baseline to be reported as a regression (default: 0.1)')
+    parser.add_option('-q', '--quiet', action='store_const', const=0, default=1, dest='verbose')
+    parser.add_option('-d', '--debug', action='store_const', const=2, dest='verbose')
+
+    (options, args) = parser.parse_args(argv[1:])
+
+    logging.basicConfig(level=logging.DEBUG if options.verbose == 2 else
+        (logging.ERROR if options.verbose == 0 else logging.INFO))
+
+    report = run_bench(options)
+
+    regressions = []
+    if options.baseline:
+        with open(options.baseline) as f:
+            regressions = compare(report, json.load(f), options.tolerance)
+
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    else:
+        print(json.dumps(report, indent=2, sort_keys=True))
+
+    if regressions:
+        logging.error('%d regressions: %s' % (len(regressions), ', '.join(regressions)))
+        sys.exit(1)
+
+# main()
+
+if __name__ == '__main__':
+
+    main(sys.argv)
@@ -56,6 +56,13 @@ class Tile(object):
     def get_mime(self):
         return mime_from_ext(self.get_ext())
 
+    def opacity(self):
+        'tile opacity as per classify_tile(), None for undecodable data'
+        try:
+            return classify_image(Image.open(StringIO.StringIO(self.data())))[0]
+        except IOError:
+            return None
+
     def close_file(self):
         if self.temp and self.path and os.path.exists(self.path):
             ld('tile', self.coord())
@@ -392,7 +399,8 @@ class TileSet(object):
         raise Exception('Not implemented!')
 
     def convert(self):
-        pf('%s -> %s ' % (self.src.root, self.root), end='')
+        if not self.options.progress: # stdout may carry the progress events
+            pf('%s -> %s ' % (self.src.root, self.root), end='')
 
         if self.pool:
             src = self.pool.imap_unordered(global_converter, self.src, chunksize=10)
@@ -412,12 +420,18 @@ class TileSet(object):
         if self.count > 0:
             self.finalize_pyramid()
             self.finalize_tileset()
-        else:
+        elif not self.options.progress:
             pf('No tiles converted', end='')
-        pf('')
+        if self.options.progress:
+            self.progress_event(finished=True)
+        else:
+            pf('')
 
     def process_tile(self, tile):
         log('process_tile', tile)
+        if self.options.drop_empty and tile.opacity() == 0:
+            tile.close_file()
+            return
         self.store_tile(tile)
         self.counter()
 
@@ -460,11 +474,30 @@ class TileSet(object):
     def counter(self):
         self.count += 1
         if self.count % self.tick_rate == 0:
-            pf('.', end='')
+            if self.options.progress:
+                self.progress_event()
+            else:
+                pf('.', end='')
             return True
         else:
             return False
 
+    def progress_event(self, finished=False):
+        'a JSON progress event, these are rate limited by the stream'
+        now = time.time()
+        if self.progress_start is None:
+            self.progress_start = now
+        elapsed = now - self.progress_start
+        progress_stream(self.options.progress, self.options.progress_interval).emit({
+            'event':    'finish' if finished else 'progress',
+            'source':   self.src.root,
+            'dest':     self.root,
+            'done':     self.count,
+            'tiles_per_s': self.count / elapsed if elapsed else None,
+            'elapsed':  elapsed,
+            }, force=finished)
+    progress_start = None
+
 # TileSet
 
 #############################
@@ -35,10 +35,6 @@ from optparse import OptionParser
 from tiler_functions import *
 
 import reader_backend
-import reader_bsb
-import reader_geo
-import reader_ozi
-import reader_kml
 
 options = None
 
@@ -60,9 +56,9 @@ def process_src(src, no_error=False, opt=None):
         lines=[f.readline() for i in range(30)]
 
     err_msg = None
-    for cls in reader_backend.reader_class_map:
-        patt=cls.magic
+    for patt, module in reader_backend.reader_modules:
         if any((l.startswith(patt) for l in lines)):
+            cls = reader_backend.reader_class(patt)
             try:
                 res = [(layer.convert(), True) for layer in cls(src,options=opt).get_layers()]
                 return res
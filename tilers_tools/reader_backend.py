@@ -43,6 +43,21 @@ from tiler_functions import *
 
 reader_class_map = []
 
+# reader modules by the magic of their files, imported once such a file is met
+reader_modules = [
+    ('KNP/',                        'reader_bsb'),
+    ('[MainChart]',                 'reader_geo'),
+    ('OziExplorer Map Data File',   'reader_ozi'),
+    ('<kml xmlns',                  'reader_kml'),
+    ]
+
+def reader_class(magic):
+    'a reader class for files starting with magic'
+    lazy_import(dict(reader_modules)[magic])
+    for cls in reader_class_map:
+        if cls.magic == magic:
+            return cls
+
 def dms2dec(degs='0',mins='0',ne='E',sec='0'):
     return (float(degs)+float(mins)/60+float(sec)/3600)*(-1 if ne in ('W','S') else 1 )
 
@@ -119,9 +134,16 @@ class RefPoints(object):
             dataset,
             METHOD='GCP_POLYNOMIAL' if not self.owner.map.options.tps else 'GCP_TPS'
         )
-        p_pix=pix_tr.transform(p_dst,inv=True)
+        p_pix,ok=pix_tr.transform_batch(p_dst,inv=True)
         #~ ld(p_pix)
-        return [(p[0],p[1]) for p in p_pix]
+        self.warn_failed(ok,'pixels')
+        return p_pix
+
+    def warn_failed(self,ok,target):
+        'points failed to transform are passed through as before, just name them'
+        failed=[i for i,k in zip(self.ids,ok) if not k]
+        if failed:
+            logging.warning(' Failed to transform reference points to %s: %s' % (target,', '.join(failed)))
 
     def grid2coord(self): # to re-implemented by children if applicable
         return self.cartesian
@@ -133,8 +155,9 @@ class RefPoints(object):
         if not dtm:
             dtm=[0,0]
         latlong=[(lon+dtm[0],lat+dtm[1]) for lon,lat in self.latlong]
-        srs_tr = GdalTransformer(SRC_SRS=proj_cs2geog_cs(self.owner.srs), DST_SRS=self.owner.srs)
-        coords=srs_tr.transform(latlong)
+        srs_tr = pooled_transformer(SRC_SRS=proj_cs2geog_cs(self.owner.srs), DST_SRS=self.owner.srs)
+        coords,ok=srs_tr.transform_batch(latlong)
+        self.warn_failed(ok,self.owner.srs)
         return coords
 
     def over_180(self):
@@ -23,15 +23,17 @@
 #  DEALINGS IN THE SOFTWARE.
 ###############################################################################
 
+import time
+import_start = time.time()
 from optparse import OptionParser
 
 from tiler_functions import *
-from tiler_backend import Pyramid, resampling_lst, base_resampling_lst
-import tiler_global_mercator
-import tiler_plate_carree
-import tiler_misc
+from tiler_backend import Pyramid, resampling_lst, base_resampling_lst, overview_engine_lst, encoder_lst, png_strategy_lst, log_stats
+from tiler_sinks import TileSink
+from tiler_queue import WorkQueue
 
 import map2gdal
+import_time = time.time() - import_start
 
 #~ import rpdb2; rpdb2.start_embedded_debugger('nRAmgJHm')
 
@@ -48,11 +50,11 @@ def preprocess_src(src):
 
 #----------------------------
 
-def process_src(src_def):
+def src_pyramid(src_def, **kw):
 
 #----------------------------
     global options
-    opt = LooseDict(options)
+    opt = LooseDict(options, **kw)
     opt.tile_format = opt.tile_format.lower()
     opt.tile_ext = '.' + opt.tile_format
     src, delete_src = src_def
@@ -62,8 +64,114 @@ def process_src(src_def):
     ext = profile.defaul_ext if opt.strip_dest_ext is None else ''
     dest = dest_path(src, opt.dest_dir, ext)
 
-    prm = profile(src, dest, opt)
+    return profile(src, dest, opt)
+
+#----------------------------
+
+def process_src(src_def):
+
+#----------------------------
+    prm = src_pyramid(src_def)
     prm.generate_tiles()
+    return prm.stats.data, prm.timing.data
+
+#----------------------------
+
+def enqueue_src(src_def):
+    'work queue jobs for a source: the whole source or its subtrees'
+#----------------------------
+    global options
+    src, delete_src = src_def
+    if not options.queue_subtrees:
+        return [(src, delete_src, None, None)]
+
+    prm = src_pyramid(src_def)
+    if not prm.prepare(target=False): # clears the destination as well
+        return []
+    roots = [tile for tile in prm.zoom_tiles(prm.subtree_zoom()) if prm.in_range(tile, check_zoom=False)]
+    ld('enqueue_src', src, len(roots))
+    return [(src, delete_src, prm.dest, list(tile)) for tile in roots]
+
+#----------------------------
+
+def queue_work(queue):
+    'process jobs until the queue is empty'
+#----------------------------
+    poll_time = min(60, queue.lease_time / 3.)
+    while True:
+        job = queue.lease()
+        if job is None:
+            if not queue.unfinished():
+                break
+            time.sleep(poll_time) # other workers' leases may expire
+            continue
+        try:
+            with queue.heartbeat(job):
+                if job.tile is None:
+                    # a retry continues the previous attempt
+                    prm = src_pyramid((job.src, job.delete_src), resume=options.resume or job.attempts > 1)
+                    prm.generate_tiles()
+                else:
+                    # a source is shared by its subtree jobs, the destination is cleared by enqueue
+                    prm = src_pyramid((job.src, False), resume=True, parallel_subtrees=None)
+                    prm.generate_subtree(job.tile)
+                del prm
+        except Exception as exc:
+            logging.exception('Job %d failed: %s %s' % (job.id, job.src, job.tile))
+            queue.fail(job, repr(exc))
+        else:
+            queue.done(job)
+
+#----------------------------
+
+def queue_finalize(queue):
+    'assemble the levels above the subtree roots and write tilemaps'
+#----------------------------
+    jobs = queue.jobs()
+    unfinished = [job for job in jobs if job[-1] != 'done']
+    if unfinished:
+        logging.error('%d jobs are not done, e.g. %s' % (len(unfinished), unfinished[0]))
+        sys.exit(1)
+
+    src_lst = []
+    for src, delete_src, dest, tile, state in jobs:
+        if tile is not None and (src, delete_src) not in src_lst:
+            src_lst.append((src, delete_src))
+    for src_def in src_lst:
+        src_pyramid(src_def, resume=True, parallel_subtrees=None).generate_tiles()
+
+#----------------------------
+
+def process_queue(src_lst):
+
+#----------------------------
+    global options
+    queue = WorkQueue(options.queue, options.lease_time)
+    try:
+        if options.queue_mode == 'enqueue':
+            # workers may run in other directories
+            for key in ('dest_dir', 'cutline', 'profile_out'):
+                path = getattr(options, key)
+                if path and (key != 'cutline' or os.path.exists(path)): # a cutline may be a DB connection
+                    setattr(options, key, os.path.abspath(path))
+            src_lst = [(os.path.abspath(src) if os.path.exists(src) else src, delete_src)
+                for src, delete_src in src_lst]
+            queue.set_options(options.__dict__)
+            queue.add_jobs(flatten(map(enqueue_src, src_lst)))
+            return
+
+        # workers and the final step use the options of the enqueued run
+        local = dict((key, getattr(options, key)) for key in ('queue', 'queue_mode', 'lease_time', 'verbose'))
+        options.__dict__.update(queue.get_options())
+        options.__dict__.update(local)
+        options.n_workers = options.n_workers or 1
+
+        if options.queue_mode == 'work':
+            queue_work(queue)
+        else:
+            queue_finalize(queue)
+    finally:
+        queue.close()
 
 #----------------------------
 
@@ -92,9 +200,33 @@ def parse_args(arg_lst):
     parser.add_option('--overview-resampling', default='nearest', metavar="METHOD1",
         choices=resampling_lst(),
         help='overview tiles resampling method (default: nearest)')
+    parser.add_option('--overview-engine', default='pil', metavar="ENGINE",
+        choices=overview_engine_lst(),
+        help='overview tiles shrinking: pil (uses --overview-resampling) or '
+        'numpy (alpha weighted 2x2 averaging, most frequent colour for paletted tiles) (default: pil)')
     parser.add_option('--base-resampling', default='nearest', metavar="METHOD2",
         choices=base_resampling_lst(),
         help='base image resampling method (default: nearest)')
+    parser.add_option('--metatile', type='int', default=1, metavar="N",
+        help='warp base image by blocks of NxN tiles, N is a power of 2 up to 16 (default: 1)')
+    parser.add_option('--read-ahead', type='int', default=0, metavar="N",
+        help='read up to N base tiles (or metatiles) ahead on a background thread (default: 0, off)')
+    parser.add_option('--render-by-zoom', action="store_true",
+        help='render each zoom level directly from the source, coarsest first and in parallel; '
+        'tilemap.json lists the levels as soon as they are complete')
+    parser.add_option('--src-overviews', default='auto', metavar="MODE",
+        choices=['auto', 'build', 'off'],
+        help='if the base zoom is much coarser than the source, warp from a downsampled source '
+        'using its overviews (auto), building them on a temporary copy if there are none (build), '
+        'or always warp from the full resolution (off) (default: auto)')
+    parser.add_option('--warp-threads', default=None, metavar="N|auto",
+        help='threads warping the base image (default: GDAL default)')
+    parser.add_option('--warp-memory', default=None, metavar="MB|auto",
+        help='warper working memory (default: GDAL default)')
+    parser.add_option('--gdal-cache', default=None, metavar="MB|auto",
+        help='GDAL raster block cache size (default: GDAL_CACHEMAX)')
+    parser.add_option('--warp-error', type='float', default=None, metavar="PIXELS",
+        help='transformer approximation error, 0 for exact transformation (default: 0.125)')
     parser.add_option('-r', '--release', action="store_true",
         help='set resampling options to (antialias,bilinear)')
     parser.add_option('--tps', action="store_true",
@@ -115,12 +247,39 @@ def parse_args(arg_lst):
         help='prefix for tile URLs at googlemaps.hml')
     parser.add_option("--tile-format", default='png', metavar="FMT",
         help='tile image format (default: png)')
+    parser.add_option("--encoder", default=None, metavar="PROFILE",
+        choices=encoder_lst(),
+        help='tile encoder profile: %s (default: PIL defaults)' % ', '.join(encoder_lst()))
+    parser.add_option("--compress-level", type='int', default=None, metavar="N",
+        help='PNG zlib compression level 0-9, overrides the encoder profile')
+    parser.add_option("--png-strategy", default=None, metavar="STRATEGY",
+        choices=png_strategy_lst(),
+        help='PNG zlib strategy: %s' % ', '.join(png_strategy_lst()))
+    parser.add_option("--quality", type='int', default=None, metavar="N",
+        help='JPEG/WebP quality, overrides the encoder profile')
+    parser.add_option("--webp-method", type='int', default=None, metavar="N",
+        help='WebP method 0 (fast) - 6 (small), overrides the encoder profile')
+    parser.add_option("--optimize", action="store_true",
+        help='optimize PNG/JPEG encoding')
+    parser.add_option("--sink", default='dir', metavar="SINK",
+        choices=TileSink.sink_lst(),
+        help='tile storage: %s (default: dir); '
+             'KML files and the viewer are written for dir only' % ', '.join(TileSink.sink_lst()))
+    parser.add_option("--write-threads", type='int', default=2, metavar="N",
+        help='threads encoding and writing tiles, 0 to do it inline (default: 2)')
+    parser.add_option("--dedup", action="store_true",
+        help='encode single colour tiles once, store identical tiles once (hardlinks or shared MBTiles images); '
+        'hardlinked tiles are to be replaced, not written in place, by other tools')
     parser.add_option("--paletted", action="store_true",
         help='convert tiles to paletted format (8 bit/pixel)')
+    parser.add_option("--global-palette", action="store_true",
+        help='with --paletted: map all tiles to a single palette sampled from the source')
     parser.add_option("-t", "--dest-dir", dest="dest_dir", default=None,
         help='destination directory (default: source)')
     parser.add_option("--noclobber", action="store_true",
         help='skip processing if the target pyramid already exists')
+    parser.add_option("--resume", action="store_true",
+        help='continue an interrupted run, skipping subtrees completed already')
     parser.add_option("-s", "--strip-dest-ext", action="store_true",
         help='do not add a default extension suffix from a destination directory')
 #    parser.add_option("--viewer-copy", action="store_true",
@@ -137,9 +296,41 @@ def parse_args(arg_lst):
         help='give an output file name  after name of a map file, otherwise after a name of an image file')
     parser.add_option("--skip-invalid", action="store_true",
         help='skip invalid/unrecognized source')
+    parser.add_option("--parallel-subtrees", action="store_true",
+        help='generate subtrees of each source in parallel instead of processing sources in parallel')
+    parser.add_option("--subtree-zoom", type='int', default=None, metavar="ZOOM",
+        help='zoom level of subtrees for --parallel-subtrees and --queue-subtrees (default: auto); '
+             'for --parallel-subtrees a coarser level is used if the finer one has over 16 subtrees per CPU')
+    parser.add_option("--progress", default=None, metavar="TARGET",
+        help='JSON lines progress events instead of dots: "-" for stdout, "unix:PATH" for a UNIX socket or a file')
+    parser.add_option("--progress-interval", type='float', default=1.0, metavar="SECONDS",
+        help='minimal interval between progress events of a process (default: 1)')
+    parser.add_option("--startup-stats", action="store_true",
+        help='report the time spent on imports and on loading modules and data on first use')
+    parser.add_option("--timing", action="store_true",
+        help='report time spent per stage and zoom level')
+    parser.add_option("--profile-out", default=None, metavar="FILE",
+        help='write cProfile data of all the processes, merged, to a file')
+    parser.add_option("--queue", default=None, metavar="DB",
+        help='work queue: an SQLite file on a volume shared by the worker nodes')
+    parser.add_option("--queue-mode", default='work', metavar="MODE",
+        choices=['enqueue', 'work', 'finalize'],
+        help='enqueue: add the sources to the queue; '
+            'work: process jobs until the queue is empty (sources are not required); '
+            'finalize: assemble the subtrees (default: work)')
+    parser.add_option("--queue-subtrees", action="store_true",
+        help='enqueue the subtrees of each source as separate jobs, these need the "finalize" step')
+    parser.add_option("--lease-time", type='int', default=None, metavar="SECONDS",
+        help='work queue job lease, renewed while the job is processed (default: 300)')
 
     (options, args) = parser.parse_args(arg_lst)
 
+    n = options.metatile
+    if not 1 <= n <= 16 or n & (n - 1): # metatiles are to match subtrees
+        parser.error('--metatile must be a power of 2 up to 16: %d' % n)
+    if options.read_ahead < 0:
+        parser.error('--read-ahead must not be negative: %d' % options.read_ahead)
+
     return (options, args)
 
 #----------------------------
@@ -154,6 +345,10 @@ def main(argv):
     logging.basicConfig(level=logging.DEBUG if options.verbose == 2 else
         (logging.ERROR if options.verbose == 0 else logging.INFO))
 
+    if options.startup_stats:
+        logging.info('startup: imports %.3fs, options parsed %.3fs after' % (
+            import_time, time.time() - import_start - import_time))
+
     ld(os.name)
     ld(options)
 
@@ -161,7 +356,7 @@ def main(argv):
         Pyramid.profile_lst(tty=True)
         return
 
-    if not args:
+    if not args and not (options.queue and options.queue_mode != 'enqueue'):
         logging.error('No input file(s) specified')
         sys.exit(1)
 
@@ -171,8 +366,39 @@ def main(argv):
     if options.release:
         options.overview_resampling, options.base_resampling = ('antialias', 'cubic')
 
-    res = parallel_map(preprocess_src, args)
-    parallel_map(process_src, flatten(res))
+    if options.overview_engine == 'numpy' and numpy is None:
+        logging.error('--overview-engine numpy requires numpy')
+        sys.exit(1)
+
+    if options.profile_out:
+        profile_start()
+
+    res = flatten(parallel_map(preprocess_src, args))
+    results = []
+    if options.queue:
+        process_queue(res)
+    elif options.parallel_subtrees: # the process pool is used inside of each source
+        options.n_workers = parallel_workers(cpu_count())
+        results = map(process_src, res)
+    else:
+        options.n_workers = parallel_workers(len(res))
+        results = parallel_map(process_src, res)
+
+    if len(results) > 1: # totals of all the sources
+        stats, timing = Counters(), Counters()
+        for src_stats, src_timing in results:
+            stats.update(src_stats)
+            timing.update(src_timing)
+        logging.info('total:')
+        log_stats(stats.data, timing.data, options.dedup, options.timing)
+
+    if options.profile_out:
+        profile_dump(options.profile_out, stop=True)
+        merge_profiles(options.profile_out)
+
+    if options.startup_stats: # in this process, pool workers inherit these
+        for name, rec in sorted(load_stats.data.items()):
+            logging.info('startup: loaded %s in %.3fs' % (name[0], rec['wall']))
 
 # main()
 
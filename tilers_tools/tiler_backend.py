@@ -26,9 +26,15 @@
 from __future__ import print_function
 import os
 import os.path
+import glob
 import shutil
 import math
+import re
+import time
 import cgi
+import StringIO
+import threading
+import collections
 from PIL import Image
 
 try:
@@ -44,10 +50,68 @@ except ImportError:
     from gdalconst import *
 
 from tiler_functions import *
-import map2gdal
+from tiler_sinks import TileSink, TileWriter
 
 profile_map = []
 
+# profile modules, imported once their profile is chosen
+profile_modules = [
+    ('zyx',     'tiler_global_mercator'),
+    ('xyz',     'tiler_global_mercator'),
+    ('tms',     'tiler_global_mercator'),
+    ('generic', 'tiler_misc'),
+    ('wgs84',   'tiler_misc'),
+    ('geo',     'tiler_plate_carree'),
+    ('xyz-geo', 'tiler_plate_carree'),
+    ('tms-geo', 'tiler_plate_carree'),
+    ]
+
+pyramid = None # a pyramid which subtrees are being generated by a process pool
+pyramid_ids = itertools.count() # to name temporary files of the pyramids of a process
+
+def make_subtree(tile):
+    'process pool worker: generate a subtree of the current pyramid, pass the statistics back'
+    profile_out = pyramid.options.profile_out
+    if profile_out:
+        profile_start()
+    try:
+        return pyramid.make_subtree(tile), pyramid.pop_stats()
+    finally:
+        if profile_out:
+            profile_dump(profile_out) # a pool worker may exit any time after
+
+def make_level(zoom):
+    'process pool worker: render a zoom level of the current pyramid, pass the statistics back'
+    profile_out = pyramid.options.profile_out
+    if profile_out:
+        profile_start()
+    try:
+        return zoom, pyramid.render_level(zoom), pyramid.pop_stats()
+    finally:
+        if profile_out:
+            profile_dump(profile_out)
+
+def log_stats(stats, timing, dedup=False, stages=False):
+    'log bytes written and encode time per zoom; wall and CPU time per stage and zoom'
+    if stats:
+        logging.info(' zoom     tiles        bytes  encode,s')
+        for zoom in sorted(stats):
+            rec = stats[zoom]
+            encode_time = timing.get(('encode', zoom), {}).get('wall', 0)
+            logging.info(' %4d %9d %12d %9.2f' % (zoom, rec['tiles'], rec['bytes'], encode_time))
+        if dedup:
+            total = lambda name: sum(rec.get(name, 0) for rec in stats.values())
+            logging.info(' dedup: %d encodes saved, %d duplicate tiles, %d bytes saved' % (
+                total('encodes_saved'), total('duplicates'), total('bytes_saved')))
+
+    log_stage = logging.info if stages else logging.debug
+    if timing:
+        log_stage(' stage               zoom     calls    wall,s     cpu,s')
+        for (stage, zoom), rec in sorted(timing.items()):
+            log_stage(' %-18s %5s %9d %9.2f %9s' % (
+                stage, '' if zoom is None else zoom, rec['calls'], rec['wall'],
+                '%.2f' % rec['cpu'] if 'cpu' in rec else '-'))
+
 resampling_map = {
     'near':     Image.NEAREST,
     'nearest':  Image.NEAREST,
@@ -58,6 +122,49 @@ resampling_map = {
 def resampling_lst():
     return resampling_map.keys()
 
+overview_engines = ['pil', 'numpy']
+def overview_engine_lst():
+    return overview_engines
+
+def halve_image(img, palette=None):
+    '''shrink an image by 2 with numpy: 2x2 box averaging, premultiplied by alpha if there is one;
+    paletted images get the most frequent index of each 2x2 block and the palette given, if any'''
+    width, height = img.size
+    n_bands = len(img.mode)
+    w, h = width // 2, height // 2
+    pixels = numpy.frombuffer(img.tobytes(), numpy.uint8).reshape(height, width, n_bands)
+    blocks = pixels[:h * 2, :w * 2].reshape(h, 2, w, 2, n_bands)
+
+    if img.mode == 'P':
+        cand = blocks.transpose(0, 2, 1, 3, 4).reshape(-1, 4) # block pixels in a row
+        votes = (cand[:, :, None] == cand[:, None, :]).sum(axis=2)
+        out = cand[numpy.arange(len(cand)), votes.argmax(axis=1)] # ties go to the top left pixel
+    else:
+        blocks = blocks.astype(numpy.uint32)
+        if 'A' in img.mode:
+            alpha = blocks[..., -1:]
+            alpha_sum = alpha.sum(axis=(1, 3))
+            color = (blocks[..., :-1] * alpha).sum(axis=(1, 3))
+            color = (color + alpha_sum // 2) // numpy.maximum(alpha_sum, 1)
+            out = numpy.concatenate((color, (alpha_sum + 2) // 4), axis=-1)
+        else:
+            out = (blocks.sum(axis=(1, 3)) + 2) // 4
+
+    half = Image.frombuffer(img.mode, (w, h), out.astype(numpy.uint8).tobytes(), 'raw', img.mode, 0, 1)
+    if img.mode == 'P':
+        palette = palette or img.getpalette() # a new canvas may have none, depending on PIL version
+        if palette:
+            half.putpalette(palette)
+        half.info = img.info.copy()
+    return half
+
+def shrink_image(img, factor, palette=None):
+    'shrink by a power of 2 by repeated halving'
+    while factor > 1:
+        img = halve_image(img, palette)
+        factor //= 2
+    return img
+
 base_resampling_map = {
     'near':         'NearestNeighbour',
     'nearest':      'NearestNeighbour',
@@ -69,6 +176,57 @@ base_resampling_map = {
 def base_resampling_lst():
     return base_resampling_map.keys()
 
+def pil_format(ext):
+    'PIL image format for a file extension'
+    Image.init()
+    return Image.EXTENSION[ext.lower()]
+
+encoder_profiles = { # PIL save() parameters per image format
+    'fast': {
+        'PNG':  dict(compress_level=1),
+        'JPEG': dict(quality=75),
+        'WEBP': dict(quality=75, method=0),
+        },
+    'balanced': {
+        'PNG':  dict(compress_level=6),
+        'JPEG': dict(quality=85),
+        'WEBP': dict(quality=80, method=4),
+        },
+    'small': {
+        'PNG':  dict(compress_level=9, optimize=True),
+        'JPEG': dict(quality=80, optimize=True),
+        'WEBP': dict(quality=75, method=6),
+        },
+    }
+def encoder_lst():
+    return sorted(encoder_profiles.keys())
+
+png_strategy_map = { # zlib strategies, PIL's compress_type
+    'default':  0,
+    'filtered': 1,
+    'huffman':  2,
+    'rle':      3,
+    'fixed':    4,
+    }
+def png_strategy_lst():
+    return sorted(png_strategy_map.keys())
+
+def encoder_params(fmt, options):
+    'PIL save() parameters: an encoder profile overridden by the explicit options'
+    params = dict(encoder_profiles[options.encoder].get(fmt, {})) if options.encoder else {}
+    if fmt == 'PNG':
+        if options.compress_level is not None:
+            params['compress_level'] = options.compress_level
+        if options.png_strategy:
+            params['compress_type'] = png_strategy_map[options.png_strategy]
+    if fmt in ('JPEG', 'WEBP') and options.quality is not None:
+        params['quality'] = options.quality
+    if fmt == 'WEBP' and options.webp_method is not None:
+        params['method'] = options.webp_method
+    if fmt in ('PNG', 'JPEG') and options.optimize:
+        params['optimize'] = True
+    return params
+
 #############################
 
 class TilingScheme(object):
@@ -118,7 +276,7 @@ class TMStiling(TilingScheme):
         'normalize according to the tile grid'
     #----------------------------
         z, x, y = super(TMStiling, self).normalize_tile(tile)
-        ntiles_x, ntiles_y = self.n_tiles_xy(zoom)
+        ntiles_x, ntiles_y = self.n_tiles_xy(z)
         return (z, x, ntiles_y - 1 - y)
 
 #############################
@@ -127,53 +285,325 @@ class BaseImg(object):
     '''Tile feeder for a base zoom level'''
 #############################
 
-    def __init__(self, dataset, tl_offsets, transparency=None):
+    def __init__(self, dataset, tl_offsets, transparency=None, metatile=1):
         self.ds = dataset
         self.tl_offsets = tl_offsets
         self.transparency = transparency
+        self.metatile = metatile
+        self.meta_key = None
+        self.prefetcher = None
 
         self.size = self.ds.RasterXSize, self.ds.RasterYSize
-        self.bands = [self.ds.GetRasterBand(i + 1) for i in range(self.ds.RasterCount)]
+        self.n_bands = self.ds.RasterCount
+        self.band_list = range(1, self.n_bands + 1)
 
     def __del__(self):
-        del self.bands
+        self.stop_read_ahead()
         del self.ds
 
+    def read_window(self, tl, sz, ds=None):
+        'read all the bands at once into a pixel interleaved buffer'
+        n = self.n_bands
+        return (ds or self.ds).ReadRaster(tl[0], tl[1], sz[0], sz[1], sz[0], sz[1], GDT_Byte,
+            band_list=self.band_list, buf_pixel_space=n, buf_line_space=n * sz[0], buf_band_space=1)
+
+    def tile_window(self, corners):
+        'top left and size of a tile inside the raster'
+        tl = tuple(corners[0][c] - self.tl_offsets[c] for c in (0, 1))
+        sz = tuple(corners[1][c] - corners[0][c] for c in (0, 1))
+        return tl, sz
+
+    def read_unit(self, tl, sz):
+        'the window read for a tile: the tile itself or its metatile'
+        if self.metatile <= 1:
+            return tl, sz
+        meta_sz = [sz[c] * self.metatile for c in (0, 1)]
+        meta_tl = tuple(tl[c] // meta_sz[c] * meta_sz[c] for c in (0, 1))
+        return meta_tl, tuple(min(meta_sz[c], self.size[c] - meta_tl[c]) for c in (0, 1))
+
+    def fetch(self, tl, sz):
+        'a window read ahead if it is there, otherwise read it now'
+        buf = self.prefetcher.take((tl, sz)) if self.prefetcher is not None else None
+        if buf is None:
+            buf = self.read_window(tl, sz)
+        return buf
+
+    def read_ahead(self, tiles_corners, ds_name, depth):
+        '''read the windows of the tiles to come on a thread with its own dataset;
+        tiles_corners are pixel corners of the tiles in the order these are to be requested'''
+        self.stop_read_ahead()
+        self.prefetcher = ReadAhead(self, gdal.Open(ds_name, GA_ReadOnly), self.read_units(tiles_corners), depth)
+        self.prefetcher.start()
+
+    def read_units(self, tiles_corners):
+        'windows to be read for the tiles, a metatile is read again only if the tiles leave it and return'
+        last = None
+        for corners in tiles_corners:
+            unit = self.read_unit(*self.tile_window(corners))
+            if unit != last:
+                yield unit
+                last = unit
+
+    def stop_read_ahead(self):
+        if self.prefetcher is not None:
+            self.prefetcher.stop()
+            self.prefetcher = None
+
+    def read_tile(self, tl, sz):
+        '''read a tile, with metatiles enabled a block of NxN tiles is warped at once then sliced'''
+        if self.metatile <= 1:
+            return self.fetch(tl, sz)
+
+        meta_tl, meta_sz = self.read_unit(tl, sz)
+        if meta_tl != self.meta_key:
+            self.meta_tl = meta_tl
+            self.meta_buf = self.fetch(meta_tl, meta_sz)
+            self.meta_width = meta_sz[0]
+            self.meta_key = meta_tl
+
+        n = self.n_bands
+        line = self.meta_width * n
+        ox, oy = [tl[c] - self.meta_tl[c] for c in (0, 1)]
+        row_offsets = [(oy + r) * line + ox * n for r in range(sz[1])]
+        row_len = sz[0] * n
+        return ''.join([self.meta_buf[i:i + row_len] for i in row_offsets])
+
     def get_tile(self, corners):
         '''crop raster as per pair of world pixel coordinates'''
 
-        tl = [corners[0][c] - self.tl_offsets[c] for c in (0, 1)]
-        sz = [corners[1][c] - corners[0][c] for c in (0, 1)]
+        tl, sz = self.tile_window(corners)
+        buf = self.read_tile(tl, sz)
+        n_bands = self.n_bands
+        opacity, color = classify_tile(buf, n_bands, self.transparency)
+        if opacity == 0:                    # fully transparent
+            return None, 0
 
-        tile_bands = [bnd.ReadRaster(tl[0], tl[1], sz[0], sz[1], sz[0], sz[1], GDT_Byte)
-                    for bnd in self.bands]
-        n_bands = len(self.bands)
         if n_bands == 1:
-            opacity = 1
-            mode = 'L'
-            if self.transparency is not None:
-                if chr(self.transparency) in tile_bands[0]:
-                    colorset = set(tile_bands[0])
-                    if len(colorset) == 1:  # fully transparent
-                        return None, 0
-                    else:                   # semi-transparent
-                        opacity = -1
-            img = Image.frombuffer('L', sz, tile_bands[0], 'raw', 'L', 0, 1)
-        else:
-            aplpha = tile_bands[-1]
-            if min(aplpha) == '\xFF':       # fully opaque
-                opacity = 1
-                tile_bands = tile_bands[:-1]
-                mode = 'RGB' if n_bands > 2 else 'L'
-            elif max(aplpha) == '\x00':     # fully transparent
-                return None, 0
-            else:                           # semi-transparent
-                opacity = -1
-                mode = 'RGBA' if n_bands > 2 else 'LA'
-            img = Image.merge(mode, [Image.frombuffer('L', sz, bnd, 'raw', 'L', 0, 1) for bnd in tile_bands])
+            img = Image.frombuffer('L', sz, buf, 'raw', 'L', 0, 1)
+        elif opacity == 1:                  # fully opaque
+            if n_bands == 4:                # skip alpha while unpacking
+                img = Image.frombuffer('RGB', sz, buf, 'raw', 'RGBX', 0, 1)
+            else:
+                img = Image.frombuffer('L', sz, buf[0::n_bands], 'raw', 'L', 0, 1)
+        else:                               # semi-transparent
+            mode = 'RGBA' if n_bands > 2 else 'LA'
+            img = Image.frombuffer(mode, sz, buf, 'raw', mode, 0, 1)
         return img, opacity
 # BaseImg
 
+#############################
+
+class ReadAhead(threading.Thread):
+    '''Read base raster windows ahead of their use into a bounded buffer,
+    so GDAL warps the next windows while the current tiles are processed'''
+#############################
+
+    def __init__(self, base_img, dataset, windows, depth):
+        super(ReadAhead, self).__init__()
+        self.daemon = True
+        self.base_img = base_img
+        self.ds = dataset # GDAL datasets are not to be shared between threads
+        self.windows = windows
+        self.depth = max(1, depth)
+        self.buffer = collections.OrderedDict() # window -> buffer, in the order of reading
+        self.reading = None
+        self.taken = collections.OrderedDict() # windows requested before these were read ahead
+        self.stopped = False
+        self.cond = threading.Condition()
+        self.hits = self.misses = 0
+
+    def run(self):
+        try:
+            for window in self.windows:
+                with self.cond:
+                    while len(self.buffer) >= self.depth and not self.stopped:
+                        self.cond.wait()
+                    if self.stopped:
+                        return
+                    if self.taken.pop(window, False): # the caller is ahead
+                        continue
+                    self.reading = window
+                buf = self.base_img.read_window(window[0], window[1], self.ds)
+                with self.cond:
+                    self.buffer[window] = buf
+                    self.reading = None
+                    self.cond.notify_all()
+        except Exception as exc: # the tiles are read by the caller then
+            ld('ReadAhead', exc)
+        finally:
+            with self.cond:
+                self.reading = None
+                self.cond.notify_all()
+            del self.ds
+
+    def take(self, window):
+        'a window read ahead, None if it is not there'
+        with self.cond:
+            while self.reading == window:
+                self.cond.wait()
+            if window not in self.buffer:
+                self.misses += 1
+                self.taken[window] = True # read by the caller, not to be read ahead
+                if len(self.taken) > self.depth: # the oldest ones are likely passed or not to come
+                    self.taken.popitem(last=False)
+                return None
+            while True: # the windows read before this one were not requested
+                first, buf = self.buffer.popitem(last=False)
+                if first == window:
+                    break
+            self.hits += 1
+            self.cond.notify_all()
+            return buf
+
+    def stop(self):
+        with self.cond:
+            self.stopped = True
+            self.cond.notify_all()
+        self.join()
+        ld('ReadAhead', 'hits', self.hits, 'misses', self.misses)
+# ReadAhead
+
+#############################
+
+class TileCoverage(object):
+    '''Tiles covered at a zoom level: a bounding box and an optional polygon bitmap'''
+#############################
+
+    max_bitmap = 1 << 24 # tiles
+
+    def __init__(self, t_tl, t_br, region=None, region_box=None):
+        self.corners = t_tl, t_br
+        self.xmin, self.ymin = t_tl[1:]
+        self.xmax, self.ymax = t_br[1:]
+        self.width = self.xmax - self.xmin + 1
+        self.region = region
+        self.bitmap = None
+        if region is not None and self.width * (self.ymax - self.ymin + 1) <= self.max_bitmap:
+            self.bitmap = self.rasterize(region, region_box)
+
+    def rasterize(self, region, region_box):
+        '''burn a region into a bitmap, a tile per pixel;
+        region_box is a box of the top left tile and a tile size'''
+        (left, top), (tile_w, tile_h) = region_box
+        height = self.ymax - self.ymin + 1
+        ds = gdal.GetDriverByName('MEM').Create('', self.width, height, 1, GDT_Byte)
+        ds.SetGeoTransform((left, tile_w, 0.0, top, 0.0, -tile_h))
+
+        ogr_ds = ogr.GetDriverByName('Memory').CreateDataSource('wrk')
+        layer = ogr_ds.CreateLayer('region')
+        feature = ogr.Feature(layer.GetLayerDefn())
+        feature.SetGeometry(region)
+        layer.CreateFeature(feature)
+        gdal.RasterizeLayer(ds, [1], layer, burn_values=[1], options=['ALL_TOUCHED=TRUE'])
+        return ds.GetRasterBand(1).ReadRaster(0, 0, self.width, height)
+
+    def intersects(self, xmin, ymin, xmax, ymax, tile_box=None):
+        '''check a range of tiles;
+        tile_box is a function returning a geometry of a tile range if no bitmap is available,
+        without it only the bounding box is checked then'''
+        xmin = max(xmin, self.xmin)
+        ymin = max(ymin, self.ymin)
+        xmax = min(xmax, self.xmax)
+        ymax = min(ymax, self.ymax)
+        if xmin > xmax or ymin > ymax:
+            return False
+        if self.region is None:
+            return True
+        if self.bitmap is None: # too many tiles for a bitmap
+            return tile_box is None or self.region.Intersects(tile_box(xmin, ymin, xmax, ymax))
+
+        x0 = xmin - self.xmin
+        x1 = xmax - self.xmin + 1
+        for y in range(ymin - self.ymin, ymax - self.ymin + 1):
+            row = y * self.width
+            if '\x01' in self.bitmap[row + x0:row + x1]:
+                return True
+        return False
+# TileCoverage
+
+#############################
+
+class GlobalPalette(object):
+    '''A palette shared by all the tiles of a pyramid, built from a sample of the source;
+    with numpy tiles are mapped to it by a lookup table indexed by RGB555 colours'''
+#############################
+
+    n_colors = 255
+    transparent = 255 # palette index of transparent pixels
+    max_sample = 1 << 18 # pixels
+
+    def __init__(self, ds):
+        self.palette = self.sample_palette(ds)
+        self.lut = self.make_lut() if numpy is not None else None
+        self.pal_img = Image.new('P', (1, 1))
+        self.pal_img.putpalette(self.palette)
+
+    def sample_palette(self, ds):
+        'quantize a decimated read of the dataset'
+        width, height = ds.RasterXSize, ds.RasterYSize
+        scale = min(1., math.sqrt(float(self.max_sample) / (width * height)))
+        w, h = max(1, int(width * scale)), max(1, int(height * scale))
+        n_bands = min(ds.RasterCount, 4)
+        buf = ds.ReadRaster(0, 0, width, height, w, h, band_list=range(1, n_bands + 1),
+            buf_pixel_space=n_bands, buf_line_space=n_bands * w, buf_band_space=1)
+        mode = {1: 'L', 2: 'LA', 3: 'RGB', 4: 'RGBA'}[n_bands]
+        sample = Image.frombuffer(mode, (w, h), buf, 'raw', mode, 0, 1)
+
+        if 'A' in mode and numpy is not None: # leave transparent pixels out
+            pixels = numpy.frombuffer(sample.convert('RGBA').tobytes(), numpy.uint8).reshape(-1, 4)
+            pixels = pixels[pixels[:, 3] >= 128, :3]
+            if len(pixels):
+                sample = Image.frombuffer('RGB', (len(pixels), 1), pixels.tobytes(), 'raw', 'RGB', 0, 1)
+
+        palette = sample.convert('RGB').convert('P', palette=Image.ADAPTIVE, colors=self.n_colors).getpalette()
+        palette = palette[:self.n_colors * 3]
+        palette += palette[:3] * (256 - len(palette) // 3) # unused entries repeat the first colour
+        ld('GlobalPalette', w, h, len(palette) // 3)
+        return palette
+
+    def make_lut(self):
+        'the nearest palette entry for every RGB555 colour'
+        pal = numpy.array(self.palette[:self.n_colors * 3], numpy.int32).reshape(-1, 3)
+        rgb555 = numpy.arange(1 << 15)
+        centers = numpy.column_stack([(rgb555 >> shift & 31) << 3 | 4 for shift in (10, 5, 0)])
+        lut = numpy.empty(1 << 15, numpy.uint8)
+        chunk = 2048
+        for i in range(0, 1 << 15, chunk):
+            dist = ((centers[i:i + chunk, None, :] - pal[None, :, :]) ** 2).sum(axis=2)
+            lut[i:i + chunk] = dist.argmin(axis=1)
+        return lut
+
+    def quantize(self, img):
+        'map an image to the palette, returns (paletted image, True if it has transparent pixels)'
+        has_alpha = 'A' in img.mode
+        img = img.convert('RGBA' if has_alpha else 'RGB')
+
+        if self.lut is not None:
+            pixels = numpy.frombuffer(img.tobytes(), numpy.uint8).reshape(-1, len(img.mode))
+            rgb555 = ((pixels[:, 0].astype(numpy.uint16) >> 3) << 10 |
+                (pixels[:, 1].astype(numpy.uint16) >> 3) << 5 | pixels[:, 2] >> 3)
+            indices = self.lut[rgb555]
+            transparent = False
+            if has_alpha:
+                mask = pixels[:, 3] < 128
+                indices[mask] = self.transparent
+                transparent = bool(mask.any())
+            p_img = Image.frombuffer('P', img.size, indices.tobytes(), 'raw', 'P', 0, 1)
+            p_img.putpalette(self.palette)
+            return p_img, transparent
+
+        # PIL fallback: the padding entries repeat the first colour, the transparent one included
+        p_img = img.convert('RGB').quantize(palette=self.pal_img)
+        p_img = p_img.point([i if i < self.n_colors else 0 for i in range(256)]) # keep opaque pixels off it
+        transparent = False
+        if has_alpha:
+            mask = img.split()[-1].point(lambda a: 255 if a < 128 else 0)
+            if mask.getbbox() is not None:
+                p_img.paste(self.transparent, None, mask)
+                transparent = True
+        return p_img, transparent
+# GlobalPalette
+
 
 #############################
 
@@ -185,10 +615,26 @@ class Pyramid(object):
 
     palette = None
     transparency = None
+    metatile = 1
+    max_solid_tiles = 4096
+    global_palette = None
+    src_res = None      # source resolution in the target SRS
+    src_reduction = 1   # source downsampling factor for the base zoom warp
+    bytes_done = 0 # bytes passed to the parent process with pop_stats()
+    count_done = 0 # progress count before the workers started, the rest is passed with pop_stats()
+    subtree_roots = 16 # subtrees per CPU at most, their root images are kept in memory
+    warp_threads = None
+    warp_memory = None  # bytes
+    warp_error = 0.125  # pixels
+    opacity_log = None
+    journal_f = None
+    sink = None
+    writer = None
     zoom_range = None
     min_res = None
     max_extent = None
     max_raster_origin = None
+    region = None
 
     default_zoom_range = (0, 22)
 
@@ -200,12 +646,21 @@ class Pyramid(object):
         gdal.UseExceptions()
 
         self.temp_files = []
+        self.temp_id = '%s-%d' % (process_id(), next(pyramid_ids)) # queue jobs share a destination
+        self.subtrees = {}
+        self.journal = {}
+        self.coverage = {}
+        self.stats = Counters() # per zoom: tiles, bytes and dedup savings
+        self.timing = Counters() # per (stage, zoom): calls, wall, cpu
+        self.solid_tiles = {} # (mode, size, color) -> encoded tile
         self.src = src
         self.dest = dest
         ld('src dest',src, dest)
         self.options = LooseDict(options)
         self.name = self.options.name
         self.tile_ext = self.options.tile_ext
+        self.save_params = encoder_params(pil_format(self.tile_ext), self.options) if self.tile_ext else {}
+        ld('save_params', self.save_params)
         self.description = ''
 
         # self.proj_srs may be changed later, for example, to avoid crossing longitude 180
@@ -213,7 +668,7 @@ class Pyramid(object):
         self.geog_srs = proj_cs2geog_cs(self.proj_srs)
         ld('proj, longlat', self.proj_srs, self.geog_srs)
 
-        self.proj2geog = GdalTransformer(SRC_SRS=self.proj_srs, DST_SRS=self.geog_srs)
+        self.proj2geog = pooled_transformer(SRC_SRS=self.proj_srs, DST_SRS=self.geog_srs)
 
         self.init_parameters()
 
@@ -222,11 +677,18 @@ class Pyramid(object):
     def __del__(self):
 
     #----------------------------
-        try:
-            if self.options.verbose < 2:
-                for f in self.temp_files:
+        if self.options.verbose < 2:
+            for f in self.temp_files:
+                try:
                     os.remove(f)
-        except: pass
+                except: pass
+
+    #----------------------------
+
+    def temp_path(self, suffix):
+        'an auxiliary file in the destination, its name is unique to this pyramid'
+    #----------------------------
+        return os.path.abspath(os.path.join(self.dest, '%s.%s%s' % (self.base, self.temp_id, suffix)))
 
     #----------------------------
 
@@ -242,6 +704,7 @@ class Pyramid(object):
             self.get_corner_coords('tl'),
             self.get_corner_coords('br')
             )
+        self.reset_coverage()
 
         ld('zoom0_tiles', self.zoom0_tiles, 'tile_size', self.tile_size, 'max_raster_origin', self.max_raster_origin, 'tile_origin', self.tile_origin,)
 
@@ -257,13 +720,16 @@ class Pyramid(object):
             self.temp_files.append(self.src)
 
         if os.path.isdir(self.dest):
-            if self.options.noclobber and os.path.exists(self.dest):
+            if self.options.resume:
+                pass # continue an interrupted run
+            elif self.options.noclobber and os.path.exists(self.dest):
                 raise RuntimeError('Target already exists: skipping')
             else:
                 shutil.rmtree(self.dest, ignore_errors=True)
 
         self.base_resampling = base_resampling_map[self.options.base_resampling]
         self.resampling = resampling_map[self.options.overview_resampling]
+        self.numpy_overviews = self.options.overview_engine == 'numpy'
 
         self.src_path = self.src
         if os.path.exists(self.src):
@@ -276,9 +742,11 @@ class Pyramid(object):
         self.description = self.src_ds.GetMetadataItem('DESCRIPTION')
 
         # source is successfully opened, then create destination dir
-        os.makedirs(self.dest)
+        if not os.path.isdir(self.dest):
+            os.makedirs(self.dest)
 
-        self.modify_src_raster()
+        with timed(self.timing, 'modify_src_raster'):
+            self.modify_src_raster()
 
     #----------------------------
 
@@ -374,7 +842,7 @@ class Pyramid(object):
                     'band_list':band_lst,
                     }
 
-                src_vrt = os.path.abspath(os.path.join(self.dest, self.base+'.src.vrt')) # auxilary VRT file
+                src_vrt = self.temp_path('.src.vrt') # auxilary VRT file
 
                 self.temp_files.append(src_vrt)
                 self.src_path = src_vrt
@@ -385,7 +853,7 @@ class Pyramid(object):
                 # finished with a paletted raster
 
         if override_srs is not None: # src SRS needs to be relpaced
-            src_vrt = os.path.join(self.dest, self.base+'.src.vrt') # auxilary VRT file
+            src_vrt = self.temp_path('.src.vrt') # auxilary VRT file
             self.temp_files.append(src_vrt)
             self.src_path = src_vrt
 
@@ -420,6 +888,7 @@ class Pyramid(object):
             (min(self.raster_corners[1][0], target_corners[1][0]),
                 max(self.raster_corners[1][1], target_corners[1][1]))
             )
+        self.reset_coverage()
 
         ld('target_corners', target_corners, self.proj2geog.transform(target_corners))
         ld('target raster', self.raster_corners, self.proj2geog.transform(self.raster_corners))
@@ -438,6 +907,7 @@ class Pyramid(object):
         auto_warp_res = self.auto_warp_res(corners)
         ld('auto_warp_corners', corners, 'auto_warp_res', auto_warp_res)
 
+        self.src_res = auto_warp_res
         max_zoom = max(self.res2zoom_xy(auto_warp_res))
 
         tl = corners[0]
@@ -457,7 +927,7 @@ class Pyramid(object):
         width = self.src_ds.RasterXSize
         height = self.src_ds.RasterYSize
 
-        n_samples = 100
+        n_samples = 256
 
         def chunks(length):
             return (int(round(i * length / n_samples)) for i in range(n_samples + 1))
@@ -468,18 +938,12 @@ class Pyramid(object):
         left_line = ((0, j) for j in chunks(height))
         right_line = ((width, j) for j in chunks(height))
 
-        def iter_transformer(*args):
-            transformer = GdalTransformer(
-                self.src_ds,
-                DST_SRS=self.proj_srs,
-                )
-            for p in itertools.chain(*args):
-                try:
-                    yield transformer.transform_point(p)
-                except RuntimeError:
-                    pass
-
-        out_pts = list(iter_transformer(top_line, bottom_line, left_line, right_line))
+        transformer = GdalTransformer(
+            self.src_ds,
+            DST_SRS=self.proj_srs,
+            )
+        out_pts, ok = transformer.transform_batch(itertools.chain(top_line, bottom_line, left_line, right_line))
+        out_pts = [p for p, p_ok in zip(out_pts, ok) if p_ok]
         #~ ld('out_pts', out_pts)
 
         xx, yy = zip(*out_pts)
@@ -506,26 +970,144 @@ class Pyramid(object):
 
     #----------------------------
 
-    def create_target_dataset(self):
+    def init_warper(self):
+        'warper threads and memory, GDAL block cache size, transformer approximation error'
+    #----------------------------
+        opt = self.options
+        n_workers = opt.n_workers or 1 # processes sharing the machine
+        ram = physical_memory()
+        mb = 1024 * 1024
+
+        def auto_memory(share): # a share of RAM per process, bytes
+            if ram is None:
+                return 256 * mb
+            return max(64 * mb, min(2048 * mb, ram // share // n_workers))
+
+        def setting(value, auto, scale=1):
+            if value is None:
+                return None
+            if value == 'auto':
+                return auto
+            return int(float(value) * scale)
+
+        self.warp_threads = setting(opt.warp_threads, max(1, cpu_count() // n_workers))
+        self.warp_memory = setting(opt.warp_memory, auto_memory(8), mb)
+        cache = setting(opt.gdal_cache, auto_memory(4), mb)
+        if opt.warp_error is not None:
+            self.warp_error = float(opt.warp_error)
+        if cache is not None:
+            gdal.SetCacheMax(cache)
+        ld('init_warper', self.warp_threads, self.warp_memory, cache, self.warp_error)
 
     #----------------------------
 
-        # adjust raster extents to tile boundaries
-        tile_tl, tile_br = self.corner_tiles(self.max_zoom)
-        ld('base_raster')
-        ld('tile_tl', tile_tl, 'tile_br', tile_br)
-        tl_c = self.tile_corners(tile_tl)[0]
-        br_c = self.tile_corners(tile_br)[1]
+    def reduction_factor(self, zoom):
+        'source downsampling factor for a zoom level, a power of 2'
+    #----------------------------
+        if self.src_res is None:
+            return 1
+        # keep twice the zoom resolution for the warper to resample from
+        ratio = self.zoom2res(zoom)[0] / self.src_res[0]
+        factor = 2 ** int(math.floor(math.log(ratio / 2, 2))) if ratio >= 4 else 1
+        width, height = self.src_ds.RasterXSize, self.src_ds.RasterYSize
+        while factor > 1 and min(width, height) // factor < self.tile_size[0]:
+            factor //= 2
+        return factor
+
+    #----------------------------
+
+    def reduce_src(self, zoom, ovr_factor=None):
+        '''when a zoom is much coarser than the source, warp from a downsampled VRT of it;
+        the VRT reads from source overviews if there are any, these may be built on a temporary copy
+        down to ovr_factor, the largest factor of the zoom levels to be warped'''
+    #----------------------------
+        mode = self.options.src_overviews or 'auto'
+        if mode == 'off' or not hasattr(gdal, 'Translate'): # GDAL < 2.1
+            return
+
+        factor = self.reduction_factor(zoom)
+        if factor < 2:
+            return
+        width, height = self.src_ds.RasterXSize, self.src_ds.RasterYSize
+
+        nearest = self.base_resampling == 'NearestNeighbour'
+        band1 = self.src_ds.GetRasterBand(1)
+        if mode == 'build' and band1.GetOverviewCount() == 0:
+            # external overviews of a VRT copy, the source itself is left alone
+            ovr_src = self.temp_path('.ovr.vrt')
+            if ovr_src not in self.temp_files: # built once, for all the levels to be warped
+                self.temp_files += [ovr_src, ovr_src + '.ovr']
+                ovr_ds = gdal.GetDriverByName('VRT').CreateCopy(ovr_src, self.src_ds)
+                ovr_factor = max(factor, ovr_factor or 1)
+                levels = [2 ** i for i in range(1, int(math.log(ovr_factor, 2)) + 1)]
+                with timed(self.timing, 'build_overviews'):
+                    ovr_ds.BuildOverviews('NEAREST' if nearest or self.palette is not None else 'AVERAGE', levels)
+                del ovr_ds
+            self.src_path = ovr_src
+            self.src_ds = gdal.Open(ovr_src, GA_ReadOnly)
+
+        reduced_src = self.temp_path('.reduced-%d.vrt' % zoom)
+        self.temp_files.append(reduced_src)
+        self.src_ds = gdal.Translate(reduced_src, self.src_ds, format='VRT',
+            width=width // factor, height=height // factor,
+            resampleAlg='near' if nearest or self.palette is not None else 'average')
+        self.src_path = reduced_src
+        self.src_reduction = factor
+        ld('reduce_src', zoom, factor, mode, width // factor, height // factor)
 
-        # warp base raster
-        base_ds = self.create_warped_vrt((tl_c, br_c), self.zoom2res(self.max_zoom))
+    #----------------------------
+
+    def create_target_dataset(self):
+
+    #----------------------------
+        self.init_warper()
+        self.metatile = self.options.metatile or 1
+
+        # warp base raster, with --render-by-zoom a raster per zoom level
+        zooms = self.zoom_range if self.options.render_by_zoom else [self.max_zoom]
+        ovr_factor = max(self.reduction_factor(zoom) for zoom in zooms)
+        with timed(self.timing, 'create_warped_vrt'):
+            self.levels = dict((zoom, self.create_level_vrt(zoom, ovr_factor)) for zoom in zooms)
 
         # close source dataset
         del self.src_ds
 
-        tl_pix = self.tile_pixcorners(tile_tl)[0]
-        # create base_image raster
-        self.base_img = BaseImg(base_ds, tl_pix, self.transparency)
+        self.base_vrt, self.base_tl_pix = self.levels[self.max_zoom]
+        self.open_base_img()
+
+    #----------------------------
+
+    def create_level_vrt(self, zoom, ovr_factor=None):
+        'a warped VRT of a zoom level and its top left pixel'
+    #----------------------------
+        src_ds, src_path = self.src_ds, self.src_path
+        try:
+            self.reduce_src(zoom, ovr_factor)
+
+            # adjust raster extents to tile boundaries
+            tile_tl, tile_br = self.corner_tiles(zoom)
+            if self.metatile > 1: # align to the metatile grid, so metatiles match both subtrees and VRT blocks
+                n = self.metatile
+                tile_tl = [tile_tl[0]] + [i // n * n for i in tile_tl[1:]]
+                # the bottom right is left at the coverage, the last metatiles are clipped by BaseImg
+            ld('base_raster', zoom)
+            ld('tile_tl', tile_tl, 'tile_br', tile_br)
+            tl_c = self.tile_corners(tile_tl)[0]
+            br_c = self.tile_corners(tile_br)[1]
+
+            vrt = self.create_warped_vrt((tl_c, br_c), self.zoom2res(zoom))
+        finally: # the next level is reduced from the original source
+            self.src_ds, self.src_path, self.src_reduction = src_ds, src_path, 1
+        return vrt, self.tile_pixcorners(tile_tl)[0]
+
+    #----------------------------
+
+    def open_base_img(self):
+        'create base_image raster, each process needs its own dataset'
+    #----------------------------
+        base_ds = gdal.Open(self.base_vrt, GA_ReadOnly)
+        self.base_img = BaseImg(base_ds, self.base_tl_pix, self.transparency, self.metatile)
+        self.base_pid = os.getpid()
 
     #----------------------------
 
@@ -550,7 +1132,7 @@ class Pyramid(object):
             ld('src_proj', self.src_ds.GetProjection(), 'gcp_proj', self.src_ds.GetGCPProjection())
             gcp_proj = txt2proj4(self.src_ds.GetGCPProjection())
             if src_proj and gcp_proj != src_proj:
-                coords = GdalTransformer(
+                coords = pooled_transformer(
                     SRC_SRS=gcp_proj,
                     DST_SRS=src_proj
                     ).transform([g[3:6] for g in gcp_lst])
@@ -569,7 +1151,7 @@ class Pyramid(object):
         size = (abs((right - left) / res[0]), abs((top - bottom) / res[0]))
 
         #tl_ll, br_ll = self.coords2longlat([tl_c, br_c])
-        ld('create_target_dataset', 'max_zoom', self.max_zoom, 'size', size[0], size[1], '-tr', res[0], res[1], '-te', tl_c[0], br_c[1], br_c[0], tl_c[1], '-t_srs', self.proj_srs)
+        ld('create_target_dataset', 'res', res, 'size', size[0], size[1], '-tr', res[0], res[1], '-te', tl_c[0], br_c[1], br_c[0], tl_c[1], '-t_srs', self.proj_srs)
 
         dst_geotr = ( left, res[0], 0.0,
                       top, 0.0, -res[1] )
@@ -583,6 +1165,8 @@ class Pyramid(object):
             return '    <Option name="%s">%s</Option>' % (name, value)
 
         warp_options.append(w_option('INIT_DEST', 'NO_DATA'))
+        if self.warp_threads:
+            warp_options.append(w_option('NUM_THREADS', self.warp_threads))
 
         # generate cut line
         if self.options.cut or self.options.cutline:
@@ -631,9 +1215,12 @@ class Pyramid(object):
             'srs':              self.proj_srs,
             'geotr':            geotr_templ % dst_geotr,
             'band_list':        '\n'.join(vrt_bands),
-            'blxsize':          self.tile_size[0],
-            'blysize':          self.tile_size[1],
+            'blxsize':          self.tile_size[0] * self.metatile,
+            'blysize':          self.tile_size[1] * self.metatile,
             'wo_ResampleAlg':   self.base_resampling,
+            'wo_WarpMemoryLimit': warp_memory_limit % float(self.warp_memory) if self.warp_memory else
+                                '    <!-- <WarpMemoryLimit>6.71089e+07</WarpMemoryLimit> -->',
+            'wo_MaxError':      self.warp_error,
             'wo_src_path':      cgi.escape(self.src_path, quote=True),
             'warp_options':     '\n'.join(warp_options),
             'wo_src_srs':       gcp_proj if gcp_proj else src_proj,
@@ -645,12 +1232,13 @@ class Pyramid(object):
             'wo_Cutline':       (warp_cutline % cut_wkt) if cut_wkt else '',
             }
 
-        temp_vrt = os.path.join(self.dest, self.base + '.tmp.vrt') # auxilary VRT file
-        self.temp_files.append(temp_vrt)
+        temp_vrt = self.temp_path('.tmp.vrt') # auxilary VRT file
+        if temp_vrt not in self.temp_files:
+            self.temp_files.append(temp_vrt)
         with open(temp_vrt, 'w') as f:
             f.write(vrt_text.encode('utf-8'))
 
-        return gdal.Open(vrt_text, GA_ReadOnly)
+        return vrt_text
 
     #----------------------------
 
@@ -660,6 +1248,9 @@ class Pyramid(object):
         cutline = self.src_ds.GetMetadataItem('CUTLINE')
         ld('cutline', cutline)
         if cutline and not self.options.cutline:
+            if self.src_reduction > 1: # pixel coordinates of the full size source
+                cutline = re.sub(r'[-+]?(\d+\.?\d*|\.\d+)([eE][-+]?\d+)?',
+                    lambda m: repr(float(m.group(0)) / self.src_reduction), cutline)
             return cutline
 
         # try to find an external cut line
@@ -678,8 +1269,8 @@ class Pyramid(object):
 
     #----------------------------
 
-    def generate_tiles(self):
-        'generate tiles'
+    def prepare(self, target=True):
+        'open the source and set up the output; False if the source is to be skipped'
     #----------------------------
 
         # connect to src dataset
@@ -688,47 +1279,342 @@ class Pyramid(object):
         except RuntimeError as exc:
             if self.options.skip_invalid:
                 logging.error(exc.message)
-                return
+                return False
             else:
                 raise
 
         self.init_output()
 
         # create a raster source for a base zoom
-        self.create_target_dataset()
+        if target:
+            if (self.options.global_palette and self.options.paletted and self.palette is None
+                    and self.options.tile_format == 'png'): # before the source is closed
+                with timed(self.timing, 'global_palette'):
+                    self.global_palette = GlobalPalette(self.src_ds)
+            self.create_target_dataset()
 
         if not self.name:
             self.name = os.path.basename(self.dest)
+        return True
+
+    #----------------------------
+
+    def generate_tiles(self):
+        'generate tiles'
+    #----------------------------
+        if self.options.profile_out:
+            profile_start()
+        if not self.prepare():
+            return
 
         ld('generate tiles')
 
         self.progress()
 
-        top_results = filter(None, itertools.imap(self.make_tile_raster, self.get_top_tiles()))
+        # each process keeps its own journal
+        journal_lst = glob.glob(os.path.join(self.dest, 'tiles*.journal'))
+        if self.options.resume:
+            self.journal = dict(itertools.chain(*map(read_opacity_log, journal_lst)))
+            ld('resume', len(self.journal))
+
+        if self.options.render_by_zoom:
+            top_tiles = self.render_levels()
+        else:
+            if self.options.parallel_subtrees:
+                self.make_subtrees()
+
+            if self.options.read_ahead:
+                self.read_ahead(self.base_tiles(self.get_top_tiles()))
+            try:
+                top_results = filter(None, itertools.imap(self.make_tile_raster, self.get_top_tiles()))
+            finally:
+                self.base_img.stop_read_ahead()
+            top_tiles = [tile for tile, img, opacity in top_results]
+            del top_results
 
         self.progress(finished=True)
 
-        children, images, opacities = zip(*top_results)
         # write top-level metadata (html/kml)
-        self.write_metadata(None, children)
+        with timed(self.timing, 'write_metadata'):
+            self.write_metadata(None, top_tiles)
+        self.get_writer().close()
+        self.report_stats()
+        if self.options.profile_out:
+            profile_dump(self.options.profile_out)
+        ld('cache_stats', cache_stats.data)
 
         # cache back tiles transparency
-        transparency = dict((
-            (self.tile_path(tile), opc)
-                for tile, opc in itertools.chain(*opacities)
+        self.close_opacity_log()
+        log_lst = glob.glob(os.path.join(self.dest, 'opacity-*.tmp'))
+        write_opacity_index(self.dest, (
+            (self.tile_path(tile), opacity)
+                for tile, opacity in itertools.chain(*map(read_opacity_log, log_lst))
             ))
-        write_transparency(self.dest, transparency)
+        for f in log_lst:
+            os.remove(f)
+
+        # the run is complete, nothing to resume
+        self.close_journal()
+        for f in glob.glob(os.path.join(self.dest, 'tiles*.journal')):
+            os.remove(f)
+
+        rss = peak_rss()
+        if rss is not None:
+            logging.info(' peak RSS %.1f MB' % (rss / 1024.))
 
     #----------------------------
 
     def get_top_tiles(self):
 
     #----------------------------
-        min_zoom = self.zoom_range[-1]
-        tile_tl, tile_br = self.corner_tiles(min_zoom)
+        return self.zoom_tiles(self.zoom_range[-1])
+
+    #----------------------------
+
+    def zoom_tiles(self, zoom):
+        'tiles covering the raster at a zoom level'
+    #----------------------------
+        tile_tl, tile_br = self.corner_tiles(zoom)
         xx = (tile_tl[1], tile_br[1])
         yy = (tile_tl[2], tile_br[2])
-        return ((min_zoom, x, y) for y in range(min(yy), max(yy)+1) for x in range(min(xx), max(xx)+1))
+        return [(zoom, x, y) for y in range(min(yy), max(yy)+1) for x in range(min(xx), max(xx)+1)]
+
+    #----------------------------
+
+    def subtree_zoom(self, max_roots=None):
+        '''zoom level of the subtrees to be generated in parallel;
+        with max_roots the level is not finer than the one with about that many subtrees'''
+    #----------------------------
+        zoom_lst = list(reversed(self.zoom_range)) # coarsest first
+        if max_roots is not None:
+            zoom_lst = [z for z in zoom_lst if self.zoom_tiles_count(z) <= max_roots] or zoom_lst[:1]
+
+        if self.options.subtree_zoom is not None:
+            finer = [z for z in zoom_lst if z >= self.options.subtree_zoom]
+            return finer[0] if finer else zoom_lst[-1]
+
+        # the coarsest level with enough subtrees to keep the pool busy
+        n_subtrees = cpu_count() * 4
+        for zoom in zoom_lst:
+            if self.zoom_tiles_count(zoom) >= n_subtrees:
+                return zoom
+        return zoom_lst[-1]
+
+    #----------------------------
+
+    def make_subtrees(self):
+        'generate subtrees in parallel, the upper levels are assembled from their results later'
+    #----------------------------
+        zoom = self.subtree_zoom(max_roots=cpu_count() * self.subtree_roots)
+        roots = self.zoom_tiles(zoom)
+        ld('make_subtrees', zoom, len(roots))
+
+        global pyramid
+        pyramid = self
+        self.count_done = self.count # the workers start counting from here
+        try:
+            results = parallel_map(make_subtree, roots)
+        finally:
+            pyramid = None
+        for res, stats in results:
+            self.merge_stats(stats)
+        self.subtrees = dict(zip(roots, [res for res, stats in results]))
+
+    #----------------------------
+
+    def render_levels(self):
+        '''render each zoom level straight from the source instead of assembling it from the finer one;
+        levels are rendered in parallel, the tilemap lists them coarsest first as soon as they are complete;
+        returns the tiles of the top level'''
+    #----------------------------
+        zooms = list(reversed(self.zoom_range)) # coarsest first
+        done = []
+        top_tiles = []
+
+        global pyramid
+        pyramid = self
+        self.count_done = self.count # the workers start counting from here
+        try:
+            for zoom, tiles, stats in parallel_imap(make_level, zooms):
+                self.merge_stats(stats)
+                if tiles is not None:
+                    top_tiles = tiles
+                done.append(zoom)
+                self.write_tilemap(done)
+                logging.info(' zoom %d is complete' % zoom)
+        finally:
+            pyramid = None
+        return top_tiles
+
+    #----------------------------
+
+    def render_level(self, zoom):
+        '''render a zoom level from its own warped VRT, may be called in a forked process;
+        returns the tiles rendered at the top level, None for the others'''
+    #----------------------------
+        top = zoom == self.zoom_range[-1]
+        level_done = (zoom, -1, -1) # a journal record of a complete level
+        if not top and self.journal.pop(level_done, None) is not None: # rendered by an interrupted run
+            return None
+
+        self.base_vrt, self.base_tl_pix = self.levels[zoom]
+        self.open_base_img()
+        self.read_ahead(tile for tile in self.level_tiles(zoom) if self.may_be_in_range(tile))
+        rendered = []
+        try:
+            for tile in self.level_tiles(zoom):
+                if not self.in_range(tile, check_zoom=False):
+                    continue
+                with timed(self.timing, 'read', zoom):
+                    tile_img, opacity = self.base_img.get_tile(self.tile_pixcorners(tile))
+                if tile_img is None:
+                    continue
+                if self.palette:
+                    tile_img.putpalette(self.palette)
+
+                with timed(self.timing, 'write', zoom):
+                    self.write_tile(tile, tile_img)
+                self.log_opacity(tile, opacity)
+
+                # children are not rendered yet, these are the tiles covered by the raster
+                with timed(self.timing, 'write_metadata', zoom):
+                    self.write_metadata(tile, self.tile_children(tile))
+                if top:
+                    rendered.append(tile)
+
+            self.journal_tile_stored(level_done, 1)
+        finally:
+            self.base_img.stop_read_ahead()
+            self.get_writer().drain()
+            for f in (self.opacity_log, self.journal_f):
+                if f is not None:
+                    f.flush() # pool workers exit without flushing files
+        return rendered if top else None
+
+    #----------------------------
+
+    def level_tiles(self, zoom):
+        'iterate over the tiles of a zoom level by metatiles, so each metatile is warped once'
+    #----------------------------
+        tile_tl, tile_br = self.corner_tiles(zoom)
+        xmin, xmax = sorted((tile_tl[1], tile_br[1]))
+        ymin, ymax = sorted((tile_tl[2], tile_br[2]))
+        n = self.metatile
+        for meta_y in range(ymin // n * n, ymax + 1, n):
+            for meta_x in range(xmin // n * n, xmax + 1, n):
+                for y in range(max(meta_y, ymin), min(meta_y + n, ymax + 1)):
+                    for x in range(max(meta_x, xmin), min(meta_x + n, xmax + 1)):
+                        yield zoom, x, y
+
+    #----------------------------
+
+    def tile_children(self, tile):
+        'tiles of the next zoom level inside the range, covered by a tile'
+    #----------------------------
+        zoom, x, y = tile
+        ch_zooms = [z for z in self.zoom_range if z > zoom]
+        if not ch_zooms:
+            return []
+        ch_zoom = min(ch_zooms)
+        len_xy = int(2 ** (ch_zoom - zoom))
+        return [ch for ch in (
+            (ch_zoom, x * len_xy + i, y * len_xy + j) for j in range(len_xy) for i in range(len_xy))
+            if self.in_range(ch, check_zoom=False)]
+
+    #----------------------------
+
+    def pop_stats(self):
+        'counters collected so far, to be passed to the parent process'
+    #----------------------------
+        stats = self.stats.pop()
+        self.bytes_done += sum(rec.get('bytes', 0) for rec in stats.values())
+        count, self.count = self.count - self.count_done, self.count_done # popped like the stats
+        return stats, self.timing.pop(), count
+
+    #----------------------------
+
+    def merge_stats(self, stats):
+        'add counters collected by another process'
+    #----------------------------
+        tile_stats, timing, count = stats
+        self.stats.update(tile_stats)
+        self.timing.update(timing)
+        self.count += count
+
+    #----------------------------
+
+    def generate_subtree(self, tile):
+        '''generate a single subtree, the upper levels are to be assembled by a resumed run;
+        used by the work queue (tiler_queue)'''
+    #----------------------------
+        if not self.prepare():
+            return
+        try:
+            result = self.make_subtree(tile)
+            if tile[0] == self.max_zoom: # not journaled by make_tile_raster()
+                self.journal_tile_stored(tile, result[2] if result else 0)
+        finally:
+            self.get_writer().close()
+            self.close_opacity_log()
+            self.close_journal()
+        self.report_stats()
+
+    #----------------------------
+
+    def make_subtree(self, tile):
+        'generate a subtree, may be called in a forked process'
+    #----------------------------
+        if self.base_pid != os.getpid():
+            self.open_base_img() # GDAL datasets are not to be shared between processes
+        if self.options.read_ahead:
+            self.read_ahead(self.base_tiles([tile]))
+        try:
+            return self.make_tile_raster(tile)
+        finally:
+            self.base_img.stop_read_ahead()
+            if self.writer is not None:
+                self.writer.drain()
+            for f in (self.opacity_log, self.journal_f):
+                if f is not None:
+                    f.flush() # pool workers exit without flushing files
+
+    #----------------------------
+
+    def read_ahead(self, tiles):
+        'let the base image read the base zoom tiles to come in the background'
+    #----------------------------
+        if self.options.read_ahead:
+            for zoom in range(min(self.zoom_range), self.max_zoom + 1): # the thread only reads these
+                self.zoom_coverage(zoom)
+            self.base_img.read_ahead(itertools.imap(self.tile_pixcorners, tiles), self.base_vrt,
+                self.options.read_ahead)
+
+    #----------------------------
+
+    def base_tiles(self, roots):
+        'base zoom tiles of subtrees in the order these are read by make_tile_raster()'
+    #----------------------------
+        # make_tile_raster() pops these while the tiles are read ahead
+        done = frozenset(self.subtrees) | frozenset(self.journal)
+        return itertools.chain.from_iterable(self.subtree_base_tiles(root, done) for root in roots)
+
+    #----------------------------
+
+    def subtree_base_tiles(self, tile, done):
+        'base zoom tiles of a subtree, except of the subtrees done already'
+    #----------------------------
+        if tile in done or not self.may_be_in_range(tile):
+            return
+        zoom, x, y = tile
+        if zoom == self.max_zoom:
+            yield tile
+            return
+        ch_zoom = self.zoom_range[self.zoom_range.index(zoom) - 1]
+        len_xy = int(2 ** (ch_zoom - zoom))
+        for j in range(len_xy):
+            for i in range(len_xy):
+                for base_tile in self.subtree_base_tiles((ch_zoom, x * len_xy + i, y * len_xy + j), done):
+                    yield base_tile
 
     #----------------------------
 
@@ -736,33 +1622,95 @@ class Pyramid(object):
 
     #----------------------------
 
+        if tile in self.subtrees: # generated already by a pool worker
+            return self.subtrees.pop(tile)
+
+        if tile in self.journal: # generated by an interrupted run
+            return self.resume_tile(tile, self.journal.pop(tile))
+
         if not self.in_range(tile, check_zoom=False):
             return
 
         zoom, x, y = tile
         if zoom == self.max_zoom: # get from the base image
-            tile_img, opacity = self.base_img.get_tile(self.tile_pixcorners(tile))
-            opacity_lst = [(tile, opacity)]
+            with timed(self.timing, 'read', zoom):
+                tile_img, opacity = self.base_img.get_tile(self.tile_pixcorners(tile))
+            children = []
         else: # merge children
-            tile_img, opacity_lst = self.assemble_tile(tile)
+            tile_img, opacity, children = self.assemble_tile(tile)
 
         #~ ld('make_tile_raster', tile, tile_img, opacity)
+        result = None
         if tile_img is not None and self.zoom_in_range(zoom):
             if self.palette:
                 tile_img.putpalette(self.palette)
 
-            self.write_tile(tile, tile_img)
+            with timed(self.timing, 'write', zoom): # waits for the writer threads, if these lag behind
+                self.write_tile(tile, tile_img)
+            self.log_opacity(tile, opacity)
 
             # write tile-level metadata (html/kml)
-            children = [ch for ch, opacity in opacity_lst[1:]]
-            self.write_metadata(tile, children)
+            with timed(self.timing, 'write_metadata', zoom):
+                self.write_metadata(tile, children)
+
+            result = tile, tile_img, opacity
 
-            return tile, tile_img, opacity_lst
+        if zoom != self.max_zoom: # the subtree is complete
+            self.journal_tile_stored(tile, opacity if result else 0)
+        return result
 
     #----------------------------
 
-    def assemble_tile(self, tile):
+    def resume_tile(self, tile, opacity):
+        'reload a tile generated by an interrupted run'
+    #----------------------------
+        if opacity == 0:
+            return None
+        data = self.get_sink().read_tile(tile, self.tile_path(tile))
+        if data is None: # not committed by the sink, regenerate
+            return self.make_tile_raster(tile)
+        tile_img = Image.open(StringIO.StringIO(data))
+        if self.palette is None:
+            tile_img = tile_img.convert('RGB' if opacity == 1 else 'RGBA')
+        else:
+            tile_img.load()
+        self.progress(zoom=tile[0])
+        return tile, tile_img, opacity
+
+    #----------------------------
+
+    def journal_tile(self, tile, opacity):
+        'record a complete subtree, each record is flushed as soon as it is written'
+    #----------------------------
+        if self.journal_f is None or self.journal_pid != os.getpid():
+            self.journal_f = open(os.path.join(self.dest, 'tiles-%s.journal' % process_id()), 'a')
+            self.journal_pid = os.getpid()
+        if self.opacity_log is not None:
+            self.opacity_log.flush() # the subtree's opacity is to be on disk first
+        write_opacity_log(self.journal_f, tile, opacity)
+        self.journal_f.flush()
+
+    #----------------------------
+
+    def journal_tile_stored(self, tile, opacity):
+        'journal a subtree once its tiles are stored'
+    #----------------------------
+        self.get_writer().call_after(lambda: self.journal_tile(tile, opacity))
+
+    #----------------------------
+
+    def close_journal(self):
+
+    #----------------------------
+        if self.journal_f is not None and self.journal_pid == os.getpid():
+            self.journal_f.close()
+        self.journal_f = None
+
+    #----------------------------
 
+    def assemble_tile(self, tile):
+        '''merge children into the parent tile;
+        children are pasted as soon as they are generated, so a single canvas per level is kept'''
     #----------------------------
 
         zoom, x, y = tile
@@ -770,68 +1718,129 @@ class Pyramid(object):
 
         # map children locations inside the parent raster
         len_xy = int(2 ** (ch_zoom - zoom))
-        children_map = dict(
-            (((ch_zoom, x * len_xy + i, y * len_xy + j), # child tile
-                (self.tile_size[0] * i, self.tile_size[1] * j)) # offset inside the parent tile
-            for i in range(len_xy) for j in range(len_xy))
-            )
+        # with gaps in the zoom range children are shrunk before pasting,
+        # the canvas is limited to 2x2 tiles
+        shrink = len_xy // 2
+        ch_size = [i // shrink for i in self.tile_size]
+        children_map = [
+            ((ch_zoom, x * len_xy + i, y * len_xy + j), # child tile
+                (ch_size[0] * i, ch_size[1] * j)) # offset inside the parent tile
+            for j in range(len_xy) for i in range(len_xy)]
         #ld(tile, ch_mozaic)
 
-        ch_results = filter(None, itertools.imap(self.make_tile_raster, children_map.keys()))
-        #~ ld('tile', tile, 'children', children, 'ch_results', ch_results)
+        tile_img = None
+        children = []
+        n_opaque = 0
+        for ch, offset in children_map:
+            ch_result = self.make_tile_raster(ch)
+            if not ch_result:
+                continue
+            ch, ch_img, ch_opacity = ch_result
+            del ch_result
+            children.append(ch)
+            if ch_opacity == 1:
+                n_opaque += 1
+
+            with timed(self.timing, 'paste', zoom):
+                if shrink > 1:
+                    if self.numpy_overviews:
+                        ch_img = shrink_image(ch_img, shrink, self.palette)
+                    else:
+                        ch_img = ch_img.resize(ch_size, self.resampling)
+                ch_mask = ch_img.split()[-1] if 'A' in ch_img.mode else None
+
+                if tile_img is None:
+                    if 'P' in ch_img.mode:
+                        tile_mode = 'P'
+                    elif 'L' in ch_img.mode:
+                        tile_mode = 'LA'
+                    else:
+                        tile_mode = 'RGBA'
+
+                    img_size = [i * 2 for i in self.tile_size]
+                    if self.transparency is not None:
+                        tile_img = Image.new(tile_mode, img_size, self.transparency)
+                    else:
+                        tile_img = Image.new(tile_mode, img_size)
+
+                tile_img.paste(ch_img, offset, ch_mask)
+                del ch_img, ch_mask
+
+        if tile_img is None:
+            return None, 0, children
 
-        opacity = 0
         # combine into the parent tile
-        if (len(ch_results) == len_xy * len_xy and
-                all([opacity_data[0][1] == 1 for ch, img, opacity_data in ch_results])
-            ):
-            opacity = 1
-            mode_opacity = ''
-        else:
-            opacity = -1
-            mode_opacity = 'A'
-
-        tile_img = None
-        opacity_lst = []
-        for ch, ch_img, opacity_data in ch_results:
-            opacity_lst.extend(opacity_data)
+        with timed(self.timing, 'resize', zoom):
+            if n_opaque == len_xy * len_xy:
+                opacity = 1
+                if tile_img.mode != 'P': # drop alpha
+                    tile_img = tile_img.convert(tile_img.mode[:-1])
+            else:
+                opacity = -1
+            if self.numpy_overviews:
+                tile_img = halve_image(tile_img, self.palette)
+            else:
+                tile_img = tile_img.resize(self.tile_size, self.resampling)
 
-            ch_mask = ch_img.split()[-1] if 'A' in ch_img.mode else None
+        return tile_img, opacity, children
 
-            if tile_img is None:
-                if 'P' in ch_img.mode:
-                    tile_mode = 'P'
-                elif 'L' in ch_img.mode:
-                    tile_mode = 'L' + mode_opacity
-                else:
-                    tile_mode = 'RGB' + mode_opacity
+    #----------------------------
 
-                img_size = [i * len_xy for i in self.tile_size]
-                if self.transparency is not None:
-                    tile_img = Image.new(tile_mode, img_size, self.transparency)
-                else:
-                    tile_img = Image.new(tile_mode, img_size)
+    def log_opacity(self, tile, opacity):
+        'stream tile opacity to a log on disk, each process keeps its own log'
+    #----------------------------
+        if self.opacity_log is None or self.opacity_log_pid != os.getpid():
+            self.opacity_log = open(os.path.join(self.dest, 'opacity-%s.tmp' % process_id()), 'a')
+            self.opacity_log_pid = os.getpid()
+        write_opacity_log(self.opacity_log, tile, opacity)
 
-            tile_img.paste(ch_img, children_map[ch], ch_mask)
+    #----------------------------
 
-        opacity_lst.insert(0, (tile, opacity))
+    def close_opacity_log(self):
 
-        return None if not tile_img else tile_img.resize(self.tile_size, self.resampling), opacity_lst
+    #----------------------------
+        if self.opacity_log is not None and self.opacity_log_pid == os.getpid():
+            self.opacity_log.close()
+        self.opacity_log = None
 
     #----------------------------
 
     def write_tile(self, tile, tile_img):
 
     #----------------------------
-        rel_path = self.tile_path(tile)
-        full_path = os.path.join(self.dest, rel_path)
-        try:
-            os.makedirs(os.path.dirname(full_path))
-        except:
-            pass
+        self.get_writer().put(tile, self.tile_path(tile), self.encode_tile, tile_img)
+        self.progress(zoom=tile[0])
+
+    #----------------------------
+
+    def encode_tile(self, tile, tile_img):
+        'called by the writer threads'
+    #----------------------------
+        with timed(self.timing, 'encode', tile[0]):
+            return self.encode_image(tile, tile_img)
+
+    #----------------------------
+
+    def encode_image(self, tile, tile_img):
+
+    #----------------------------
+        solid_key = None
+        if self.options.dedup: # a single colour tile is encoded once per colour
+            opacity, color = classify_image(tile_img)
+            if color is not None:
+                solid_key = (tile_img.mode, tile_img.size, color)
+                data = self.solid_tiles.get(solid_key)
+                if data is not None:
+                    self.stats.add(tile[0], tiles=1, bytes=len(data), encodes_saved=1)
+                    return data
 
         tile_format = self.options.tile_format
-        if self.options.paletted and tile_format == 'png':
+        transparency = self.transparency
+        if self.global_palette is not None:
+            tile_img, has_transparency = self.global_palette.quantize(tile_img)
+            if has_transparency:
+                transparency = GlobalPalette.transparent
+        elif self.options.paletted and tile_format == 'png':
             try:
                 tile_img = tile_img.convert('P', palette=Image.ADAPTIVE, colors=255)
             except ValueError:
@@ -845,12 +1854,45 @@ class Pyramid(object):
                 #ld('tile_img.mode', tile_img.mode)
                 pass
 
-        if self.transparency is not None:
-            tile_img.save(full_path, transparency=self.transparency)
+        buf = StringIO.StringIO()
+        if transparency is not None:
+            tile_img.save(buf, pil_format(self.tile_ext), transparency=transparency, **self.save_params)
         else:
-            tile_img.save(full_path)
+            tile_img.save(buf, pil_format(self.tile_ext), **self.save_params)
+        data = buf.getvalue()
+        if solid_key is not None and len(self.solid_tiles) < self.max_solid_tiles:
+            self.solid_tiles[solid_key] = data
+        self.stats.add(tile[0], tiles=1, bytes=len(data))
+        return data
 
-        self.progress()
+    #----------------------------
+
+    def report_stats(self):
+
+    #----------------------------
+        log_stats(self.stats.data, self.timing.data, self.options.dedup, self.options.timing)
+
+    #----------------------------
+
+    def get_sink(self):
+        'tile storage, each process opens its own'
+    #----------------------------
+        if self.sink is None or self.sink_pid != os.getpid():
+            self.sink = TileSink.get_class(self.options.sink or 'dir')(self)
+            self.sink_pid = os.getpid()
+            self.writer = None
+        return self.sink
+
+    #----------------------------
+
+    def get_writer(self):
+        'tile encoding and writing pipeline, threads do not survive fork()'
+    #----------------------------
+        sink = self.get_sink()
+        if self.writer is None:
+            n_threads = self.options.write_threads
+            self.writer = TileWriter(sink, 2 if n_threads is None else n_threads)
+        return self.writer
 
     #----------------------------
 
@@ -862,12 +1904,14 @@ class Pyramid(object):
 
     #----------------------------
 
-    def write_tilemap(self):
-        '''Generate JSON for a tileset description'''
+    def write_tilemap(self, zooms=None):
+        '''Generate JSON for a tileset description, listing the zoom levels given or all of them'''
     #----------------------------
+        if zooms is None:
+            zooms = self.zoom_range
 
         # reproject extents back to the unshifted SRS
-        bbox = GdalTransformer(SRC_SRS=self.proj_srs, DST_SRS=self.srs).transform(self.raster_corners)
+        bbox = pooled_transformer(SRC_SRS=self.proj_srs, DST_SRS=self.srs).transform(self.raster_corners)
 
         tile_mime = mime_from_ext(self.tile_ext)
         tilemap = {
@@ -899,11 +1943,11 @@ class Pyramid(object):
                 (zoom,
                     {"href": 'z%d' % zoom,
                     "units_per_pixel": self.zoom2res(zoom)[0]})
-                for zoom in reversed(self.zoom_range)]),
+                for zoom in sorted(zooms)]),
             }
 
 
-        write_tilemap(self.dest, tilemap)
+        self.get_sink().write_tilemap(tilemap)
         #~ ld('tilemap', tilemap)
 
     #----------------------------
@@ -914,6 +1958,8 @@ class Pyramid(object):
 
     @staticmethod
     def profile_class(profile_name):
+        if profile_name in dict(profile_modules):
+            lazy_import(dict(profile_modules)[profile_name])
         for cls in profile_map:
             if cls.profile == profile_name:
                 return cls
@@ -923,7 +1969,9 @@ class Pyramid(object):
     @staticmethod
     def profile_lst(tty=False):
         if not tty:
-            return [c.profile for c in profile_map]
+            return [name for name, module in profile_modules]
+        for name, module in profile_modules: # for the descriptions
+            lazy_import(module)
         print('\nOutput profiles and compatibility:\n')
         [print('%10s - %s' % (c.profile, c.__doc__)) for c in profile_map]
         print()
@@ -1001,14 +2049,37 @@ class Pyramid(object):
             ] for tl, br in zip(tl_lst, br_lst)]
 
     def corner_tiles(self, zoom):
+        return self.zoom_coverage(zoom).corners
+
+    def zoom_coverage(self, zoom):
+        'coverage index of a zoom level, built once per zoom'
+        try:
+            return self.coverage[zoom]
+        except KeyError:
+            pass
+
         p_tl = self.coord2pix(zoom, self.raster_corners[0])
         t_tl = self.pix2tile(zoom, (p_tl[0], p_tl[1]))
 
         p_br = self.coord2pix(zoom, self.raster_corners[1])
         t_br = self.pix2tile(zoom, (p_br[0], p_br[1]))
 
-        box_tl, box_br = [self.tile_corners(t) for t in (t_tl, t_br)]
-        return t_tl, t_br
+        region_box = (
+            self.tile_corners(t_tl)[0],
+            [r * sz for r, sz in zip(self.zoom2res(zoom), self.tile_size)])
+        cov = TileCoverage(t_tl, t_br, self.region, region_box)
+        self.coverage[zoom] = cov
+        return cov
+
+    def reset_coverage(self):
+        'to be called once the raster area or the tile grid origin change'
+        self.coverage = {}
+
+    def tile_range_geometry(self, zoom, xmin, ymin, xmax, ymax):
+        left, top = self.tile_corners((zoom, xmin, ymin))[0]
+        right, bottom = self.tile_corners((zoom, xmax, ymax))[1]
+        return ogr.CreateGeometryFromWkt('POLYGON((%r %r,%r %r,%r %r,%r %r,%r %r))' % (
+            left, top, right, top, right, bottom, left, bottom, left, top))
 
     def set_zoom_range(self, zoom_parm, default_range=None):
         'set a list of zoom levels from a parameter list'
@@ -1060,45 +2131,58 @@ class Pyramid(object):
         if check_zoom and not self.zoom_in_range(zoom):
             return False
 
-        tl_zoom, br_zoom = self.corner_tiles(zoom)
-
-        # Y axis goes downwards
-        z, zoom_xmin, zoom_ymin = tl_zoom
-        z, zoom_xmax, zoom_ymax = br_zoom
-
-        out = not (
-            tile_xmin > zoom_xmax or tile_xmax < zoom_xmin or
-            tile_ymin > zoom_ymax or tile_ymax < zoom_ymin
-            )
-
-        #~ ld('in_range zoom', tl_zoom, br_zoom)
-        #~ ld('in_range tile', tl_tile, br_tile, res)
+        return self.zoom_coverage(zoom).intersects(
+            tile_xmin, tile_ymin, tile_xmax, tile_ymax,
+            lambda *box: self.tile_range_geometry(zoom, *box))
 
-        return out
+    def may_be_in_range(self, tile):
+        '''in_range() for the read-ahead thread: it reads prebuilt coverage only,
+        OGR geometries are not used, so a tile outside of a region may pass'''
+        zoom, x, y = tile
+        return self.coverage[zoom].intersects(x, y, x, y)
 
     def set_region(self, point_lst, source_srs=None):
         if source_srs and source_srs != self.proj_srs:
-            point_lst = GdalTransformer(SRC_SRS=source_srs, DST_SRS=self.proj_srs).transform(point_lst)
+            point_lst = pooled_transformer(SRC_SRS=source_srs, DST_SRS=self.proj_srs).transform(point_lst)
 
         x_coords, y_coords = zip(*point_lst)[0:2]
         top_left = min(x_coords), max(y_coords)
         bottom_right = max(x_coords), min(y_coords)
         self.raster_corners = [top_left, bottom_right]
+        self.region = None
+        self.reset_coverage()
 
     def load_region(self, datasource):
         if not datasource:
             return
-        point_lst = flatten(shape2mpointlst(datasource, self.proj_srs))
+        ring_lst = shape2mpointlst(datasource, self.proj_srs)
+        point_lst = flatten(ring_lst)
         #~ ld(datasource, point_lst)
         self.set_region(point_lst)
 
+        # keep the polygons themselves, holes are ignored
+        region = ogr.Geometry(ogr.wkbMultiPolygon)
+        for points in ring_lst:
+            ring = ogr.Geometry(ogr.wkbLinearRing)
+            for p in points:
+                ring.AddPoint_2D(p[0], p[1])
+            ring.CloseRings()
+            polygon = ogr.Geometry(ogr.wkbPolygon)
+            polygon.AddGeometry(ring)
+            region.AddGeometry(polygon)
+        self.region = region
+        self.reset_coverage()
+
     # progress display
     tick_rate = 50
     count = 0
-    def progress(self, finished=False):
+    def progress(self, finished=False, zoom=None):
         #~ pf('+', end='')
         #~ return
-        if self.options.verbose == 0:
+        if self.options.progress:
+            if self.count == 0 or finished or self.count % self.tick_rate == 0:
+                self.progress_event(finished, zoom)
+        elif self.options.verbose == 0:
             pass
         elif finished:
             pf('')
@@ -1106,6 +2190,44 @@ class Pyramid(object):
             pf('.', end='')
         self.count += 1
 
+    def progress_event(self, finished=False, zoom=None):
+        'a JSON progress event, these are rate limited by the stream'
+        stream = progress_stream(self.options.progress, self.options.progress_interval)
+        now = time.time()
+        if self.count == 0:
+            self.progress_start = now
+            stream.emit({
+                'event':    'start',
+                'source':   self.src,
+                'dest':     self.dest,
+                'zooms':    self.zoom_range,
+                'total':    self.tiles_total(),
+                }, force=True)
+            return
+        elapsed = now - self.progress_start
+        stream.emit({
+            'event':    'finish' if finished else 'progress',
+            'source':   self.src,
+            'zoom':     zoom,
+            'done':     self.count,
+            'total':    self.tiles_total(),
+            'tiles_per_s': self.count / elapsed if elapsed else None,
+            'bytes':    self.bytes_done + sum(rec.get('bytes', 0) for rec in self.stats.data.values()),
+            'elapsed':  elapsed,
+            }, force=finished)
+
+    tiles_estimate = None
+    def tiles_total(self):
+        'an estimate of the number of tiles: the tile ranges of all the zoom levels'
+        if self.tiles_estimate is None:
+            self.tiles_estimate = sum(map(self.zoom_tiles_count, self.zoom_range))
+        return self.tiles_estimate
+
+    def zoom_tiles_count(self, zoom):
+        'the number of zoom_tiles(), without listing them'
+        (z, xmin, ymin), (z, xmax, ymax) = self.corner_tiles(zoom)
+        return (abs(xmax - xmin) + 1) * (abs(ymax - ymin) + 1)
+
 # Pyramid
 
 #############################
@@ -1160,13 +2282,14 @@ class MercatorPyramid(Pyramid):
             return ' '.join(proj_new)
         # srs_replace
 
-        tl, br = GdalTransformer(
+        (tl, br), ok = GdalTransformer(
             self.src_ds,
             DST_SRS=self.geog_srs
-            ).transform([
+            ).transform_batch([
             (0, 0),
             (self.src_ds.RasterXSize, self.src_ds.RasterYSize)])
         ld('shift_srs tl', tl, 'br', br)
+        assert all(ok), 'Failed to transform raster corners of %s' % self.src
 
         l_lon = tl[0]
         r_lon = br[0]
@@ -1183,7 +2306,7 @@ class MercatorPyramid(Pyramid):
         new_srs = srs_replace(self.proj_srs, new_parms)
         ld( 'lon_0', lon_0, 'l_lon', l_lon, 'r_lon', r_lon)
 
-        old2new = GdalTransformer(
+        old2new = pooled_transformer(
             SRC_SRS=self.proj_srs,
             DST_SRS=new_srs
             )
@@ -1191,7 +2314,7 @@ class MercatorPyramid(Pyramid):
 
         if shift_x != 0:
             self.proj_srs = new_srs
-            self.proj2geog = GdalTransformer(
+            self.proj2geog = pooled_transformer(
                 SRC_SRS=self.proj_srs,
                 DST_SRS=self.geog_srs
                 )
@@ -1199,6 +2322,7 @@ class MercatorPyramid(Pyramid):
                 self.max_raster_origin[0] + shift_x,
                 self.max_raster_origin[1]
                 )
+            self.reset_coverage()
             ld('new_srs', new_srs, 'shift_x', shift_x, 'max_raster_origin', self.max_raster_origin)
 
 #----------------------------
@@ -1218,14 +2342,14 @@ warp_vrt = '''<VRTDataset rasterXSize="%(xsize)d" rasterYSize="%(ysize)d" subCla
   <BlockXSize>%(blxsize)d</BlockXSize>
   <BlockYSize>%(blysize)d</BlockYSize>
   <GDALWarpOptions>
-    <!-- <WarpMemoryLimit>6.71089e+07</WarpMemoryLimit> -->
+%(wo_WarpMemoryLimit)s
     <ResampleAlg>%(wo_ResampleAlg)s</ResampleAlg>
     <WorkingDataType>Byte</WorkingDataType>
     <SourceDataset relativeToVRT="0">%(wo_src_path)s</SourceDataset>
 %(warp_options)s
     <Transformer>
       <ApproxTransformer>
-        <MaxError>0.125</MaxError>
+        <MaxError>%(wo_MaxError)r</MaxError>
         <BaseTransformer>
           <GenImgProjTransformer>
 %(wo_src_transform)s
@@ -1248,6 +2372,7 @@ warp_vrt = '''<VRTDataset rasterXSize="%(xsize)d" rasterYSize="%(ysize)d" subCla
 '''
 warp_band = '  <VRTRasterBand dataType="Byte" band="%d" subClass="VRTWarpedRasterBand"%s>'
 warp_band_color = '>\n    <ColorInterp>%s</ColorInterp>\n  </VRTRasterBand'
+warp_memory_limit = '    <WarpMemoryLimit>%r</WarpMemoryLimit>'
 warp_dst_alpha_band = '    <DstAlphaBand>%d</DstAlphaBand>\n'
 warp_cutline = '    <Cutline>%s</Cutline>\n'
 warp_dst_geotr = '            <DstGeoTransform> %r, %r, %r, %r, %r, %r</DstGeoTransform>'
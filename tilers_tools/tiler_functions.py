@@ -40,6 +40,18 @@ import locale
 import csv
 import htmlentitydefs
 import json
+import socket
+import time
+import glob
+import contextlib
+import cProfile
+import pstats
+import threading
+import functools
+import collections
+import array
+import mmap
+import struct
 
 try:
     from osgeo import gdal
@@ -53,6 +65,11 @@ except ImportError:
     import ogr
     from gdalconst import *
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 try:
     import multiprocessing # available in python 2.6 and above
 
@@ -93,7 +110,8 @@ def parallel_map(func, iterable):
     ld('parallel_map', multiprocessing)
     #~ return map(func, iterable)
 
-    if multiprocessing is None or len(iterable) < 2:
+    if (multiprocessing is None or len(iterable) < 2
+            or multiprocessing.current_process().daemon): # pool workers can't have children
         return map(func, iterable)
     else:
         # map in parallel
@@ -104,6 +122,34 @@ def parallel_map(func, iterable):
         mp_pool.join()
     return res
 
+def parallel_imap(func, iterable):
+    'parallel_map() yielding the results in order, as soon as each one is ready'
+    if (multiprocessing is None or len(iterable) < 2
+            or multiprocessing.current_process().daemon):
+        for res in itertools.imap(func, iterable):
+            yield res
+        return
+    mp_pool = multiprocessing.Pool()
+    try:
+        for res in mp_pool.imap(func, iterable):
+            yield res
+    finally:
+        mp_pool.close()
+        mp_pool.join()
+
+def cpu_count():
+    try:
+        return multiprocessing.cpu_count()
+    except (AttributeError, NotImplementedError):
+        return 1
+
+def parallel_workers(n_items):
+    'number of processes parallel_map() runs for n_items'
+    if (multiprocessing is None or n_items < 2
+            or multiprocessing.current_process().daemon):
+        return 1
+    return min(n_items, cpu_count())
+
 def flatten(two_level_list):
     return list(itertools.chain(*two_level_list))
 
@@ -216,6 +262,139 @@ class LooseDict(object):
     def update(self, other_dict):
         self.__dict__.update(other_dict)
 
+class Counters(object):
+    'thread-safe sums of named values per key; the plain dict data can be passed between processes'
+    def __init__(self):
+        self.data = {}
+        self.lock = threading.Lock()
+
+    def add(self, key, **values):
+        with self.lock:
+            rec = self.data.setdefault(key, {})
+            for name, value in values.items():
+                rec[name] = rec.get(name, 0) + value
+
+    def update(self, data):
+        'merge counters collected elsewhere'
+        for key, rec in data.items():
+            self.add(key, **rec)
+
+    def pop(self):
+        'counters collected so far, starting anew'
+        with self.lock:
+            data = self.data
+            self.data = {}
+        return data
+
+cache_stats = Counters() # per cache: hits, misses
+
+try: # CPU time of the calling thread, time.clock() counts the whole process on POSIX
+    import ctypes
+    import ctypes.util
+
+    class timespec(ctypes.Structure):
+        _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+    clock_gettime = ctypes.CDLL(ctypes.util.find_library('rt') or ctypes.util.find_library('c'),
+        use_errno=True).clock_gettime
+    clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+    CLOCK_THREAD_CPUTIME_ID = 3 # Linux
+
+    def thread_cpu_time():
+        ts = timespec()
+        if clock_gettime(CLOCK_THREAD_CPUTIME_ID, ctypes.byref(ts)) != 0:
+            return None
+        return ts.tv_sec + ts.tv_nsec * 1e-9
+
+    if not sys.platform.startswith('linux') or thread_cpu_time() is None:
+        raise OSError('no thread CPU clock')
+except (ImportError, OSError, AttributeError, TypeError):
+    def thread_cpu_time():
+        'the process CPU time is good for the main thread only, others get wall time only'
+        if isinstance(threading.current_thread(), threading._MainThread):
+            return time.clock()
+        return None
+
+@contextlib.contextmanager
+def timed(counters, stage, zoom=None):
+    '''add wall and CPU time and a call count of a block to counters[(stage, zoom)];
+    CPU time is the calling thread's one, it is left out where such a clock is not available'''
+    wall, cpu = time.time(), thread_cpu_time()
+    try:
+        yield
+    finally:
+        values = dict(calls=1, wall=time.time() - wall)
+        if cpu is not None:
+            values['cpu'] = thread_cpu_time() - cpu
+        counters.add((stage, zoom), **values)
+
+load_stats = Counters() # per lazily loaded module or data: calls, wall, cpu
+
+def lazy_import(name):
+    'import a module on first use'
+    if name not in sys.modules:
+        with timed(load_stats, name):
+            __import__(name)
+    return sys.modules[name]
+
+class lazy_class_attr(object):
+    'a class attribute computed on first use'
+    def __init__(self, func):
+        self.func = func
+        self.name = func.__name__
+
+    def __get__(self, obj, cls):
+        with timed(load_stats, '%s.%s' % (cls.__name__, self.name)):
+            value = self.func(cls)
+        setattr(cls, self.name, value)
+        return value
+
+profilers = {} # pid -> cProfile.Profile, forked processes get their own
+
+def profile_start():
+    'start or continue profiling this process'
+    prof = profilers.get(os.getpid())
+    if prof is None:
+        prof = profilers[os.getpid()] = cProfile.Profile()
+    prof.enable()
+
+def profile_dump(out_path, stop=False):
+    'write this process\' profile next to out_path, to be merged by merge_profiles()'
+    prof = profilers.get(os.getpid())
+    if prof is None:
+        return
+    prof.dump_stats('%s.part-%s' % (out_path, process_id())) # stops profiling
+    if not stop:
+        prof.enable()
+
+def merge_profiles(out_path):
+    'merge the processes\' profiles into out_path'
+    parts = glob.glob(out_path + '.part-*')
+    if not parts:
+        return
+    pstats.Stats(*parts).dump_stats(out_path)
+    for f in parts:
+        os.remove(f)
+
+def memoize(func):
+    'process-wide cache of the results of a function of hashable arguments'
+    cache = {}
+    name = func.__name__
+
+    @functools.wraps(func)
+    def wrapper(*args):
+        try:
+            res = cache[args]
+        except KeyError:
+            res = cache[args] = func(*args)
+            cache_stats.add(name, misses=1)
+        except TypeError: # unhashable arguments
+            return func(*args)
+        else:
+            cache_stats.add(name, hits=1)
+        return res
+    return wrapper
+
 #############################
 #
 # GDAL utility functions
@@ -251,11 +430,17 @@ def load_geo_defs(csv_file):
     return defs
 
 geo_defs_override_file = 'data_override.csv'
-geo_defs_override = load_geo_defs(geo_defs_override_file)
 
-def txt2srs(proj):
+@memoize
+def geo_defs_override():
+    'definitions overriding the GDAL ones, loaded on first use'
+    with timed(load_stats, geo_defs_override_file):
+        return load_geo_defs(geo_defs_override_file)
+
+@memoize
+def parse_srs(proj):
     srs = osr.SpatialReference()
-    proj_ovr = geo_defs_override['proj'].get(proj)
+    proj_ovr = geo_defs_override()['proj'].get(proj)
     if proj_ovr:
         proj = str(proj_ovr[0])
     if proj.startswith(("GEOGCS", "GEOCCS", "PROJCS", "LOCAL_CS")):
@@ -267,14 +452,21 @@ def txt2srs(proj):
         srs.ImportFromProj4(proj)
     return srs
 
+def txt2srs(proj):
+    'a copy of the cached SRS, so the caller may modify it'
+    return parse_srs(proj).Clone()
+
+@memoize
 def txt2wkt(proj):
     srs = txt2srs(proj)
     return srs.ExportToWkt()
 
+@memoize
 def txt2proj4(proj):
     srs = txt2srs(proj)
     return srs.ExportToProj4()
 
+@memoize
 def proj_cs2geog_cs(proj):
     srs = txt2srs(proj)
     srs_geo = osr.SpatialReference()
@@ -299,8 +491,46 @@ class GdalTransformer(gdal.Transformer):
 
     def transform_point(self, point, inv=False):
         return self.transform([point], inv=inv)[0]
+
+    def transform_batch(self, points, inv=False):
+        'transform all the points in one call, returns (points, per point success flags)'
+        points = [tuple(p) for p in points]
+        if not points:
+            return [], []
+        try:
+            transformed, ok = self.TransformPoints(inv, points)
+        except RuntimeError: # an error is raised for the whole batch, retry point by point
+            transformed, ok = [], []
+            for p in points:
+                try:
+                    (t,), (k,) = self.TransformPoints(inv, [p])
+                except RuntimeError:
+                    t, k = p, 0
+                transformed.append(t)
+                ok.append(k)
+        return [i[:2] for i in transformed], [bool(k) for k in ok]
 # GdalTransformer
 
+transformer_pool = collections.OrderedDict() # least recently used first
+transformer_pool_size = 32
+transformer_pool_lock = threading.Lock()
+
+def pooled_transformer(**options):
+    'a shared GdalTransformer between coordinate systems (no datasets), from an LRU pool'
+    key = tuple(sorted(options.items()))
+    with transformer_pool_lock:
+        try:
+            transformer = transformer_pool.pop(key)
+        except KeyError:
+            transformer = GdalTransformer(**options)
+            cache_stats.add('pooled_transformer', misses=1)
+        else:
+            cache_stats.add('pooled_transformer', hits=1)
+        transformer_pool[key] = transformer
+        if len(transformer_pool) > transformer_pool_size:
+            transformer_pool.popitem(last=False)
+    return transformer
+
 def sasplanet_hlg2ogr(fname):
     with open(fname) as f:
         lines = f.readlines(4096)
@@ -396,9 +626,10 @@ def shape2mpointlst(datasource, dst_srs, feature_name=None):
                     layer_proj = layer_srs.ExportToProj4()
                 else:
                     layer_proj = dst_srs
-                srs_tr = GdalTransformer(SRC_SRS=layer_proj, DST_SRS=dst_srs)
                 if layer_proj == dst_srs:
-                    srs_tr.transform = lambda x:x
+                    transform = lambda x:x
+                else: # a pooled transformer is shared, it is not to be modified
+                    transform = pooled_transformer(SRC_SRS=layer_proj, DST_SRS=dst_srs).transform
 
                 multipoint_lst = []
                 for geometry in geom_lst:
@@ -406,7 +637,7 @@ def shape2mpointlst(datasource, dst_srs, feature_name=None):
                     for ln in (geometry.GetGeometryRef(j) for j in range(geometry.GetGeometryCount())):
                         assert ln.GetGeometryName() == 'LINEARRING'
                         src_points = [ln.GetPoint(n) for n in range(ln.GetPointCount())]
-                        dst_points = srs_tr.transform(src_points)
+                        dst_points = transform(src_points)
                         #~ ld(src_points)
                         multipoint_lst.append(dst_points)
                 ld('mpointlst', layer_proj, dst_srs, multipoint_lst)
@@ -466,6 +697,19 @@ def link_or_copy(src, dst):
             except shutil.Error, shutil_exception:
                 raise shutil_exception
 
+def replace_file(src, dst):
+    'rename src to dst, on POSIX dst is replaced atomically'
+    if os.name != 'posix' and os.path.exists(dst):
+        os.remove(dst)
+    os.rename(src, dst)
+
+def save_image(img, path, **params):
+    'save a PIL image via a temporary file: a tile hardlinked by --dedup is replaced, not written through'
+    base, ext = os.path.splitext(path)
+    temp_path = '%s.tmp-%d%s' % (base, os.getpid(), ext) # PIL picks the format by the extension
+    img.save(temp_path, **params)
+    replace_file(temp_path, path)
+
 def copy_viewer(dest):
     for f in ['viewer-google.html', 'viewer-openlayers.html']:
         src = os.path.join(data_dir(), f)
@@ -482,12 +726,273 @@ def read_transparency(src_dir):
     return transparency
 
 def write_transparency(dst_dir, transparency):
+    'transparency is either a dict or an iterable of (tile_path, opacity) pairs, the latter is written as it goes'
+    if isinstance(transparency, dict):
+        transparency = transparency.iteritems()
     try:
         with open(os.path.join(dst_dir, 'transparency.json'), 'w') as f:
-            json.dump(transparency, f, indent=0)
+            sep = '{\n'
+            for tile_path, opacity in transparency:
+                f.write('%s%s: %s' % (sep, json.dumps(tile_path), json.dumps(opacity)))
+                sep = ',\n'
+            f.write('{}\n' if sep == '{\n' else '\n}\n')
     except:
         logging.warning("transparency cache save failure")
 
+def write_opacity_log(f, tile, opacity):
+    f.write('%d %d %d %d\n' % (tuple(tile) + (opacity,)))
+
+def read_opacity_log(path):
+    'iterate over (tile, opacity) records of an opacity log'
+    with open(path, 'r') as f:
+        for l in f:
+            try:
+                z, x, y, opacity = map(int, l.split())
+            except ValueError: # truncated record
+                continue
+            yield (z, x, y), opacity
+
+#############################
+#
+# opacity index: a grid of 2 bit values per zoom level
+#
+#############################
+
+opacity_index_name = 'opacity.idx'
+opacity_index_magic = 'TTOPIDX1'
+opacity_index_header = struct.Struct('<8sI') # magic, number of levels
+opacity_index_level = struct.Struct('<iiiiiQ') # zoom, left, top, width, height, grid offset
+opacity_codes = {0: 1, 1: 2, -1: 3} # code 0 is for tiles not in the index
+opacity_values = [None, 0, 1, -1]
+tile_path_re = re.compile(r'^z?(\d+)/(\d+)/(\d+)(\.[^/]*)?$')
+
+def parse_tile_path(tile_path):
+    'zoom and the numbers of a tile path as laid out in a tileset: z/x/y.ext or zZ/y/x.ext'
+    match = tile_path_re.match(tile_path.replace(os.sep, '/'))
+    return tuple(map(int, match.groups()[:3])) if match else None
+
+def write_opacity_index(dst_dir, opacity):
+    '''opacity is either a dict or an iterable of (tile_path, opacity) pairs;
+    these are collected into arrays per zoom, then written as grids covering each level'''
+    if isinstance(opacity, dict):
+        opacity = opacity.iteritems()
+    levels = {}
+    for tile_path, value in opacity:
+        key = parse_tile_path(tile_path)
+        if key is None or value not in opacity_codes:
+            continue
+        zoom, a, b = key
+        if zoom not in levels:
+            levels[zoom] = array.array('l'), array.array('l'), array.array('b')
+        for arr, v in zip(levels[zoom], (a, b, value)):
+            arr.append(v)
+
+    path = os.path.join(dst_dir, opacity_index_name)
+    try:
+        with open(path + '.tmp', 'wb') as f:
+            f.write(opacity_index_header.pack(opacity_index_magic, len(levels)))
+            offset = opacity_index_header.size + opacity_index_level.size * len(levels)
+            grids = []
+            for zoom in sorted(levels):
+                aa, bb, values = levels[zoom]
+                left, top = min(aa), min(bb)
+                width, height = max(aa) - left + 1, max(bb) - top + 1
+                grid = bytearray((width * height + 3) // 4)
+                for a, b, v in itertools.izip(aa, bb, values): # later records win
+                    i = (b - top) * width + a - left
+                    shift = (i & 3) * 2
+                    grid[i >> 2] = grid[i >> 2] & ~(3 << shift) | opacity_codes[v] << shift
+                f.write(opacity_index_level.pack(zoom, left, top, width, height, offset))
+                offset += len(grid)
+                grids.append(grid)
+            for grid in grids:
+                f.write(grid)
+        replace_file(path + '.tmp', path)
+    except (IOError, OSError):
+        logging.warning("opacity index save failure")
+
+#############################
+
+class OpacityIndex(object):
+    'a memory mapped opacity index, get() looks up opacity by a tile path'
+#############################
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, n_levels = opacity_index_header.unpack_from(self.data)
+        if magic != opacity_index_magic:
+            raise ValueError('Invalid opacity index: %s' % path)
+        self.levels = {}
+        for i in range(n_levels):
+            rec = opacity_index_level.unpack_from(self.data,
+                opacity_index_header.size + opacity_index_level.size * i)
+            self.levels[rec[0]] = rec[1:]
+
+    def __getstate__(self): # the mapping is not passed to pool workers, these open the file again
+        return self.path
+
+    def __setstate__(self, path):
+        self.__init__(path)
+
+    def get(self, tile_path, default=None):
+        key = parse_tile_path(tile_path)
+        if key is None or key[0] not in self.levels:
+            return default
+        zoom, a, b = key
+        left, top, width, height, offset = self.levels[zoom]
+        if not (0 <= a - left < width and 0 <= b - top < height):
+            return default
+        i = (b - top) * width + a - left
+        value = opacity_values[ord(self.data[offset + (i >> 2)]) >> (i & 3) * 2 & 3]
+        return default if value is None else value
+
+    def __contains__(self, tile_path):
+        return self.get(tile_path) is not None
+
+def read_opacity_index(src_dir):
+    'an opacity index of a tileset, a dict loaded from transparency.json for older ones'
+    path = os.path.join(src_dir, opacity_index_name)
+    if os.path.exists(path):
+        try:
+            return OpacityIndex(path)
+        except (ValueError, struct.error, EnvironmentError):
+            ld("opacity index load failure")
+    return read_transparency(src_dir)
+
+#############################
+#
+# tile classification
+#
+#############################
+
+# numpy dtypes to compare whole pixels at once
+pixel_dtypes = {1: 'u1', 2: '<u2', 4: '<u4'}
+
+def classify_tile(buf, n_bands, transparency=None):
+    '''classify a pixel interleaved tile buffer, 2 and 4 band buffers have an alpha band;
+    returns (opacity, color): opacity is 0 if empty, 1 if opaque, -1 if partially transparent;
+    color is a tuple of band values if all the pixels are the same, otherwise None'''
+
+    if numpy is not None:
+        pixels = numpy.frombuffer(buf, numpy.uint8)
+        if n_bands in (2, 4):
+            alpha = pixels[n_bands - 1::n_bands]
+            if not alpha.any():
+                return 0, None
+            opacity = 1 if alpha.min() == 255 else -1
+        elif n_bands == 1 and transparency is not None:
+            transparent = pixels == transparency
+            if transparent.all():
+                return 0, None
+            opacity = -1 if transparent.any() else 1
+        else:
+            opacity = 1
+
+        if n_bands in pixel_dtypes:
+            pixels = pixels.view(pixel_dtypes[n_bands])
+            solid = not (pixels != pixels[0]).any()
+        else:
+            pixels = pixels.reshape(-1, n_bands)
+            solid = not (pixels != pixels[0]).any()
+    else: # string methods are still run in C
+        first = buf[:n_bands]
+        if n_bands in (2, 4):
+            alpha = buf[n_bands - 1::n_bands]
+            if alpha.count('\x00') == len(alpha):
+                return 0, None
+            opacity = 1 if alpha.count('\xFF') == len(alpha) else -1
+        elif n_bands == 1 and transparency is not None:
+            n_transparent = buf.count(chr(transparency))
+            if n_transparent == len(buf):
+                return 0, None
+            opacity = -1 if n_transparent else 1
+        else:
+            opacity = 1
+        solid = buf == first * (len(buf) // n_bands)
+
+    color = tuple(bytearray(buf[:n_bands])) if solid else None
+    return opacity, color
+
+def classify_image(img):
+    'classify a PIL image, see classify_tile()'
+    if img.mode not in ('L', 'LA', 'RGB', 'RGBA'):
+        img = img.convert('RGBA')
+    transparency = img.info.get('transparency') if img.mode == 'L' else None
+    return classify_tile(img.tobytes(), len(img.mode), transparency)
+
+try:
+    import resource
+except ImportError: # non POSIX
+    resource = None
+
+def peak_rss():
+    'peak resident set size of this process and its children, KB'
+    if resource is None:
+        return None
+    return max(resource.getrusage(who).ru_maxrss
+        for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN))
+
+def process_id():
+    'host and pid, unique among the processes sharing a volume'
+    return '%s-%d' % (socket.gethostname(), os.getpid())
+
+class ProgressStream(object):
+    '''Progress events as JSON lines to stdout ("-"), a UNIX socket ("unix:PATH") or a file,
+    events are dropped if sent more often than min_interval'''
+    min_interval = 1.0 # seconds
+
+    def __init__(self, target, min_interval=None):
+        if min_interval is not None:
+            self.min_interval = min_interval
+        self.last = 0
+        self.sock = None
+        self.f = None
+        if target == '-':
+            self.f = sys.stdout
+        elif target.startswith('unix:'):
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.sock.connect(target[len('unix:'):])
+        else:
+            self.f = open(target, 'a')
+
+    def emit(self, event, force=False):
+        'send an event dict unless the previous one was sent too recently'
+        now = time.time()
+        if not force and now - self.last < self.min_interval:
+            return False
+        self.last = now
+        event['time'] = now
+        event['worker'] = process_id()
+        line = json.dumps(event) + '\n'
+        try:
+            if self.sock is not None:
+                self.sock.sendall(line)
+            elif self.f is not None:
+                self.f.write(line) # a single line is written by a single system call
+                self.f.flush()
+        except (IOError, socket.error) as exc: # the listener is gone, carry on without it
+            logging.warning('progress stream: %s' % exc)
+            self.sock = self.f = None
+        return True
+
+progress_streams = {} # (pid, target) -> ProgressStream
+
+def progress_stream(target, min_interval=None):
+    'a progress stream of this process'
+    key = (os.getpid(), target)
+    if key not in progress_streams:
+        progress_streams[key] = ProgressStream(target, min_interval)
+    return progress_streams[key]
+
+def physical_memory():
+    'total RAM, bytes; None if unknown'
+    try:
+        return os.sysconf('SC_PHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (AttributeError, ValueError, OSError): # non POSIX
+        return None
+
 type_map = (
     ('image/png', '.png', '\x89PNG\x0D\x0A\x1A\x0A'),
     ('image/jpeg', '.jpg', '\xFF\xD8\xFF\xE0'),
@@ -59,7 +59,7 @@ class GMercatorZYX(GMercator, ZYXtiling):
     def write_metadata(self, tile=None, children=[]):
         super(GMercatorZYX, self).write_metadata(tile, children)
 
-        if tile is None:
+        if tile is None and self.get_sink().file_tree:
             copy_viewer(self.dest)
 #
 profile_map.append(GMercatorZYX)
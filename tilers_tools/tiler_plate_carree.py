@@ -41,12 +41,15 @@ class PlateCarree(MercatorPyramid):
     # projection where the meridians and parallels are equidistant, straight lines, with the two sets
     # crossing at right angles. This projection is also known as Lat/Lon WGS84"
 
-    # Equirectangular (EPSG:32662 aka plate carrée, aka Simple Cylindrical)
-    # we use this because the SRS might be shifted later to work around 180 meridian
-    srs = '+proj=eqc +datum=WGS84 +ellps=WGS84'
+    @lazy_class_attr
+    def srs(cls):
+        # Equirectangular (EPSG:32662 aka plate carrée, aka Simple Cylindrical)
+        # we use this because the SRS might be shifted later to work around 180 meridian
+        srs = '+proj=eqc +datum=WGS84 +ellps=WGS84'
 
-    # set units to degrees, this makes this SRS essentially equivalent to EPSG:4326
-    srs += ' +to_meter=%f' % (GdalTransformer(DST_SRS=srs, SRC_SRS=proj_cs2geog_cs(srs)).transform_point((1, 0))[0])
+        # set units to degrees, this makes this SRS essentially equivalent to EPSG:4326
+        srs += ' +to_meter=%f' % (pooled_transformer(DST_SRS=srs, SRC_SRS=proj_cs2geog_cs(srs)).transform_point((1, 0))[0])
+        return srs
 
     #~ srs = 'EPSG:4326'
 
@@ -82,6 +85,8 @@ class PlateCarree(MercatorPyramid):
 
     def write_metadata(self, tile=None, children=[]):
         super(PlateCarree, self).write_metadata(tile, children)
+        if not self.get_sink().file_tree: # no place for KML files next to the tiles
+            return
 
         if tile is None: # create top level kml
             self.write_kml(os.path.basename(self.base), os.path.basename(self.base), self.kml_child_links(children))
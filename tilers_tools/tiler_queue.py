@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+###############################################################################
+# Copyright (c) 2011-2013 Vadim Shlyakhov
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a
+#  copy of this software and associated documentation files (the "Software"),
+#  to deal in the Software without restriction, including without limitation
+#  the rights to use, copy, modify, merge, publish, distribute, sublicense,
+#  and/or sell copies of the Software, and to permit persons to whom the
+#  Software is furnished to do so, subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included
+#  in all copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+#  OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+#  THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+#  FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+#  DEALINGS IN THE SOFTWARE.
+###############################################################################
+
+from __future__ import with_statement
+import os
+import time
+import json
+import sqlite3
+import threading
+
+from tiler_functions import *
+
+#############################
+
+class WorkQueue(object):
+    '''A job table in an SQLite file on a volume shared by the worker nodes.
+    A job is a whole source or a subtree of a source; workers lease jobs,
+    renew the lease while working and mark jobs done; expired leases are taken over'''
+#############################
+    lease_time = 300    # seconds
+    max_attempts = 3    # a job failing that many times is given up
+
+    def __init__(self, path, lease_time=None):
+        self.path = path
+        if lease_time:
+            self.lease_time = lease_time
+        self.worker = process_id()
+        self.db = self.connect()
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS jobs ('
+                'id INTEGER PRIMARY KEY, '
+                'src TEXT, '
+                'delete_src INTEGER, '
+                'dest TEXT, '
+                'tile TEXT, '           # subtree root as JSON [z, x, y], NULL for a whole source
+                'state TEXT, '          # pending, leased, done, failed
+                'worker TEXT, '
+                'expires REAL, '
+                'attempts INTEGER DEFAULT 0, '
+                'error TEXT);'
+            )
+        self.db.execute('CREATE TABLE IF NOT EXISTS metadata (name TEXT PRIMARY KEY, value TEXT);')
+
+    def connect(self):
+        'transactions are explicit; no WAL, as it does not work over NFS'
+        return sqlite3.connect(self.path, timeout=600, isolation_level=None)
+
+    def set_options(self, options):
+        'tiler options shared by the workers'
+        self.db.execute('INSERT OR REPLACE INTO metadata (name, value) VALUES (?, ?);',
+            ('options', json.dumps(options)))
+
+    def get_options(self):
+        row = self.db.execute('SELECT value FROM metadata WHERE name = ?;', ('options',)).fetchone()
+        return json.loads(row[0]) if row else {}
+
+    def add_jobs(self, jobs):
+        'jobs are (src, delete_src, dest, tile) tuples'
+        self.db.execute('BEGIN IMMEDIATE;')
+        self.db.executemany(
+            'INSERT INTO jobs (src, delete_src, dest, tile, state) VALUES (?, ?, ?, ?, ?);',
+            [(src, int(bool(delete_src)), dest, json.dumps(tile) if tile else None, 'pending')
+                for src, delete_src, dest, tile in jobs])
+        self.db.execute('COMMIT;')
+
+    def lease(self):
+        'take a pending job or a job with an expired lease; None if there is none at the moment'
+        self.db.execute('BEGIN IMMEDIATE;') # one worker at a time
+        try:
+            now = time.time()
+            row = self.db.execute(
+                'SELECT id, src, delete_src, dest, tile, attempts FROM jobs '
+                    'WHERE state = ? OR (state = ? AND expires < ?) ORDER BY id LIMIT 1;',
+                ('pending', 'leased', now)).fetchone()
+            if row is None:
+                return None
+            self.db.execute(
+                'UPDATE jobs SET state = ?, worker = ?, expires = ?, attempts = attempts + 1 WHERE id = ?;',
+                ('leased', self.worker, now + self.lease_time, row[0]))
+        finally:
+            self.db.execute('COMMIT;')
+
+        job_id, src, delete_src, dest, tile, attempts = row
+        ld('lease', job_id, src, tile, attempts)
+        return LooseDict(
+            id=job_id,
+            src=src,
+            delete_src=bool(delete_src),
+            dest=dest,
+            tile=tuple(json.loads(tile)) if tile else None,
+            attempts=attempts + 1,
+            )
+
+    def heartbeat(self, job):
+        'a thread renewing the lease of a job until stopped'
+        return Heartbeat(self, job)
+
+    def done(self, job):
+        self.db.execute('UPDATE jobs SET state = ?, expires = NULL WHERE id = ?;', ('done', job.id))
+
+    def fail(self, job, error):
+        'put the job back to the queue, unless it failed too many times'
+        state = 'failed' if job.attempts >= self.max_attempts else 'pending'
+        self.db.execute('UPDATE jobs SET state = ?, expires = NULL, error = ? WHERE id = ? AND worker = ?;',
+            (state, error, job.id, self.worker))
+
+    def unfinished(self):
+        'number of jobs neither done, nor failed'
+        return self.db.execute('SELECT count(*) FROM jobs WHERE state IN (?, ?);',
+            ('pending', 'leased')).fetchone()[0]
+
+    def jobs(self):
+        'all the jobs as (src, delete_src, dest, tile, state) tuples'
+        return [(src, bool(delete_src), dest, tuple(json.loads(tile)) if tile else None, state)
+            for src, delete_src, dest, tile, state in self.db.execute(
+                'SELECT src, delete_src, dest, tile, state FROM jobs ORDER BY id;')]
+
+    def close(self):
+        self.db.close()
+
+#############################
+
+class Heartbeat(threading.Thread):
+    'renew a job lease periodically, on its own connection'
+#############################
+
+    def __init__(self, queue, job):
+        super(Heartbeat, self).__init__()
+        self.daemon = True
+        self.queue = queue
+        self.job = job
+        self.stopped = threading.Event()
+
+    def run(self):
+        db = self.queue.connect()
+        try:
+            while not self.stopped.wait(self.queue.lease_time / 3.):
+                db.execute('UPDATE jobs SET expires = ? WHERE id = ? AND worker = ? AND state = ?;',
+                    (time.time() + self.queue.lease_time, self.job.id, self.queue.worker, 'leased'))
+        finally:
+            db.close()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.stopped.set()
+        self.join()
@@ -0,0 +1,376 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+###############################################################################
+# Copyright (c) 2011-2013 Vadim Shlyakhov
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a
+#  copy of this software and associated documentation files (the "Software"),
+#  to deal in the Software without restriction, including without limitation
+#  the rights to use, copy, modify, merge, publish, distribute, sublicense,
+#  and/or sell copies of the Software, and to permit persons to whom the
+#  Software is furnished to do so, subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included
+#  in all copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+#  OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+#  THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+#  FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+#  DEALINGS IN THE SOFTWARE.
+###############################################################################
+
+from __future__ import print_function
+import os
+import os.path
+import time
+import json
+import hashlib
+import collections
+import threading
+import Queue
+
+from tiler_functions import *
+
+tile_sinks = []
+
+#############################
+
+class TileSink(object):
+    '''Storage for encoded tiles and a tileset description'''
+#############################
+    sink_name = None
+    file_tree = False # tiles are files in dest, the viewer and KML files are written next to them
+
+    def __init__(self, pyramid):
+        self.pyramid = pyramid
+        self.dest = pyramid.dest
+        self.dedup = pyramid.options.dedup
+        ld('TileSink', self.sink_name, self.dest)
+
+    def count_duplicate(self, tile, data):
+        self.pyramid.stats.add(tile[0], duplicates=1, bytes_saved=len(data))
+
+    def write_tile(self, tile, rel_path, data):
+        'store an encoded tile'
+        raise Exception('Not implemented!')
+
+    def read_tile(self, tile, rel_path):
+        'encoded tile data, None if not available'
+        return None
+
+    def write_tilemap(self, tilemap):
+        pass
+
+    def flush(self):
+        'make written tiles persistent'
+        pass
+
+    def close(self):
+        self.flush()
+
+    @staticmethod
+    def get_class(name):
+        for cls in tile_sinks:
+            if name == cls.sink_name:
+                return cls
+        else:
+            raise Exception('Invalid tile sink: %s' % name)
+
+    @staticmethod
+    def sink_lst():
+        return [cls.sink_name for cls in tile_sinks]
+
+#############################
+
+class DirSink(TileSink):
+    'a directory tree of tile files'
+#############################
+    sink_name = 'dir'
+    file_tree = True
+    max_digests = 100000 # remembered tile hashes, least recently used are forgotten
+
+    def __init__(self, pyramid):
+        super(DirSink, self).__init__(pyramid)
+        self.dirs = set()
+        self.digests = collections.OrderedDict() # hash -> path of a tile with this content
+        self.lock = threading.Lock()
+
+    def write_tile(self, tile, rel_path, data):
+        full_path = os.path.join(self.dest, rel_path)
+        tile_dir = os.path.dirname(full_path)
+        if tile_dir not in self.dirs:
+            try:
+                os.makedirs(tile_dir)
+            except os.error:
+                pass
+            self.dirs.add(tile_dir)
+
+        # write via a temporary file, so a partial tile is never left under the final name
+        temp_path = full_path + '.tmp'
+        if self.dedup and self.link_duplicate(tile, data, temp_path, full_path):
+            self.count_duplicate(tile, data)
+        else:
+            with open(temp_path, 'wb') as f:
+                f.write(data)
+        replace_file(temp_path, full_path)
+
+    def link_duplicate(self, tile, data, temp_path, full_path):
+        'hardlink a tile with the same content, if any; otherwise remember this one'
+        digest = hashlib.sha1(data).digest()
+        with self.lock:
+            orig = self.digests.pop(digest, None)
+            self.digests[digest] = orig or full_path
+            if len(self.digests) > self.max_digests:
+                self.digests.popitem(last=False)
+        if orig is None:
+            return False
+        try:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            os.link(orig, temp_path)
+            return True
+        except (OSError, AttributeError): # non POSIX, too many links or the original is gone
+            with self.lock:
+                self.digests[digest] = full_path # this copy becomes the original
+            return False
+
+    def read_tile(self, tile, rel_path):
+        try:
+            with open(os.path.join(self.dest, rel_path), 'rb') as f:
+                return f.read()
+        except IOError:
+            return None
+
+    def write_tilemap(self, tilemap):
+        write_tilemap(self.dest, tilemap)
+
+tile_sinks.append(DirSink)
+
+#############################
+
+class MBTilesSink(TileSink):
+    'a single MBTiles (SQLite) file'
+#############################
+    sink_name = 'mbtiles'
+    batch_size = 1000 # tiles per transaction
+    max_hold = 0.5 # seconds a transaction may keep the file locked, other processes may be waiting
+
+    def __init__(self, pyramid):
+        super(MBTilesSink, self).__init__(pyramid)
+
+        import sqlite3
+
+        self.path = os.path.join(self.dest, os.path.basename(self.dest) + '.mbtiles')
+        self.lock = threading.Lock() # tiles are written by TileWriter's threads
+        # pool workers write to the same file: a transaction takes the write lock as it begins,
+        # so waiting for it goes through the busy handler, a lock upgrade midway could fail at once
+        self.db = sqlite3.connect(self.path, timeout=600, # other processes may hold a lock
+            check_same_thread=False, isolation_level='IMMEDIATE')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+
+        # an existing file keeps its schema
+        tables = set(row[0] for row in self.db.execute('SELECT name FROM sqlite_master;'))
+        self.dedup = 'images' in tables or (self.dedup and 'tiles' not in tables)
+        if self.dedup: # tiles share images by content hash
+            self.db.execute(
+                'CREATE TABLE IF NOT EXISTS map ('
+                    'zoom_level INTEGER, '
+                    'tile_column INTEGER, '
+                    'tile_row INTEGER, '
+                    'tile_id TEXT, '
+                    'PRIMARY KEY (zoom_level, tile_column, tile_row));'
+                )
+            self.db.execute('CREATE TABLE IF NOT EXISTS images (tile_id TEXT PRIMARY KEY, tile_data BLOB);')
+            self.db.execute(
+                'CREATE VIEW IF NOT EXISTS tiles AS SELECT '
+                    'map.zoom_level AS zoom_level, '
+                    'map.tile_column AS tile_column, '
+                    'map.tile_row AS tile_row, '
+                    'images.tile_data AS tile_data '
+                    'FROM map JOIN images ON images.tile_id = map.tile_id;'
+                )
+        else:
+            self.db.execute(
+                'CREATE TABLE IF NOT EXISTS tiles ('
+                    'zoom_level INTEGER, '
+                    'tile_column INTEGER, '
+                    'tile_row INTEGER, '
+                    'tile_data BLOB, '
+                    'PRIMARY KEY (zoom_level, tile_column, tile_row));'
+                )
+        self.db.execute('CREATE TABLE IF NOT EXISTS metadata (name TEXT PRIMARY KEY, value TEXT);')
+        self.db.commit()
+        self.pending = 0
+        self.began = None
+
+    def mbtiles_coord(self, tile):
+        'MBTiles rows go upwards'
+        z, x, y = tile
+        ntiles_x, ntiles_y = self.pyramid.n_tiles_xy(z)
+        return z, x % ntiles_x, ntiles_y - 1 - y
+
+    def write_tile(self, tile, rel_path, data):
+        if self.dedup:
+            tile_id = hashlib.sha1(data).hexdigest()
+        with self.lock:
+            if self.dedup:
+                cursor = self.db.execute(
+                    'INSERT OR IGNORE INTO images (tile_id, tile_data) VALUES (?, ?);',
+                    (tile_id, buffer(data)))
+                if cursor.rowcount == 0:
+                    self.count_duplicate(tile, data)
+                self.db.execute(
+                    'INSERT OR REPLACE INTO map (zoom_level, tile_column, tile_row, tile_id) VALUES (?, ?, ?, ?);',
+                    self.mbtiles_coord(tile) + (tile_id,))
+            else:
+                self.db.execute(
+                    'INSERT OR REPLACE INTO tiles (zoom_level, tile_column, tile_row, tile_data) VALUES (?, ?, ?, ?);',
+                    self.mbtiles_coord(tile) + (buffer(data),))
+            self.pending += 1
+            if self.began is None:
+                self.began = time.time()
+            if self.pending >= self.batch_size or time.time() - self.began >= self.max_hold:
+                self.db.commit()
+                self.pending = 0
+                self.began = None
+
+    def read_tile(self, tile, rel_path):
+        with self.lock:
+            row = self.db.execute(
+                'SELECT tile_data FROM tiles WHERE zoom_level=? AND tile_column=? AND tile_row=?;',
+                self.mbtiles_coord(tile)).fetchone()
+        return str(row[0]) if row else None
+
+    def write_tilemap(self, tilemap):
+        prm = self.pyramid
+        (west, north), (east, south) = prm.coords2longlat(prm.raster_corners)
+        metadata = {
+            'name':         tilemap['properties']['title'],
+            'description':  tilemap['properties']['description'] or '',
+            'type':         'overlay',
+            'version':      '1.1',
+            'format':       tilemap['tiles']['ext'],
+            'bounds':       '%r,%r,%r,%r' % (west, south, east, north),
+            'minzoom':      min(tilemap['tilesets']),
+            'maxzoom':      max(tilemap['tilesets']),
+            'tilemap':      json.dumps(tilemap),
+            }
+        with self.lock:
+            self.db.executemany('INSERT OR REPLACE INTO metadata (name, value) VALUES (?, ?);', metadata.items())
+            self.db.commit()
+
+    def flush(self):
+        with self.lock:
+            self.db.commit()
+            self.pending = 0
+            self.began = None
+
+    def close(self):
+        self.flush()
+        self.db.close()
+
+tile_sinks.append(MBTilesSink)
+
+#############################
+
+class NullSink(TileSink):
+    'discard tiles (for benchmarking)'
+#############################
+    sink_name = 'null'
+
+    def write_tile(self, tile, rel_path, data):
+        pass
+
+tile_sinks.append(NullSink)
+
+#############################
+
+class TileWriter(object):
+    '''Encode and store tiles on a pool of threads, so encoding and I/O overlap rendering;
+    PIL encoders and file I/O release the GIL'''
+#############################
+
+    def __init__(self, sink, n_threads=2, max_queued=None):
+        self.sink = sink
+        self.lock = threading.Lock()
+        self.submitted = 0
+        self.outstanding = set()    # tiles being encoded or stored
+        self.callbacks = []         # (sequence number, function)
+        self.error = None
+
+        # a bounded queue keeps memory capped: put() blocks once it is full
+        self.queue = Queue.Queue(max_queued or n_threads * 4)
+        self.threads = [threading.Thread(target=self.worker) for i in range(n_threads)]
+        for t in self.threads:
+            t.daemon = True
+            t.start()
+
+    def put(self, tile, rel_path, encode, tile_img):
+        'a tile image is encoded by encode(tile, tile_img)'
+        self.check_error()
+        if not self.threads:
+            self.sink.write_tile(tile, rel_path, encode(tile, tile_img))
+            return
+        with self.lock:
+            seq = self.submitted
+            self.submitted += 1
+            self.outstanding.add(seq)
+        self.queue.put((seq, tile, rel_path, encode, tile_img))
+        self.run_callbacks()
+
+    def call_after(self, func):
+        'call func once all the tiles submitted so far are stored'
+        with self.lock:
+            self.callbacks.append((self.submitted, func))
+        self.run_callbacks()
+
+    def run_callbacks(self):
+        'run ready callbacks in the calling thread'
+        with self.lock:
+            done = min(self.outstanding) if self.outstanding else self.submitted
+            ready = [func for seq, func in self.callbacks if seq <= done]
+            self.callbacks = [(seq, func) for seq, func in self.callbacks if seq > done]
+        for func in ready:
+            func()
+
+    def worker(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                seq, tile, rel_path, encode, tile_img = item
+                del item
+                try:
+                    self.sink.write_tile(tile, rel_path, encode(tile, tile_img))
+                except Exception:
+                    self.error = sys.exc_info()
+                with self.lock:
+                    self.outstanding.discard(seq)
+            finally:
+                self.queue.task_done()
+
+    def check_error(self):
+        if self.error is not None:
+            exc_type, exc_value, exc_tb = self.error
+            raise exc_type, exc_value, exc_tb
+
+    def drain(self):
+        'wait until all the submitted tiles are stored'
+        self.queue.join()
+        self.check_error()
+        self.run_callbacks()
+        self.sink.flush()
+
+    def close(self):
+        self.drain()
+        for t in self.threads:
+            self.queue.put(None)
+        for t in self.threads:
+            t.join()
+        self.threads = []
+        self.sink.close()
@@ -77,6 +77,8 @@ def main(argv):
         help='convert output tiles to format (default: no conversion)')
     parser.add_option('--list-formats', '--lf', action='store_true',
         help='list tile format converters')
+    parser.add_option('--drop-empty', action='store_true',
+        help='skip fully transparent tiles')
     parser.add_option("-n", "--colors", dest="colors", default='256',
         help='Specifies  the  number  of colors for pngnq profile (default: 256)')
     parser.add_option("-q", "--quality", dest="quality", type="int", default=75,
@@ -109,6 +111,10 @@ def main(argv):
         help='apply region for zooms only higher than this one (default: None)')
     parser.add_option("--nothreads", action="store_true",
         help="do not use multiprocessing")
+    parser.add_option("--progress", default=None, metavar="TARGET",
+        help='JSON lines progress events instead of dots: "-" for stdout, "unix:PATH" for a UNIX socket or a file')
+    parser.add_option("--progress-interval", type='float', default=1.0, metavar="SECONDS",
+        help='minimal interval between progress events (default: 1)')
 
     parser.add_option('-d', '--debug', action='store_true', dest='debug')
     parser.add_option('--quiet', action='store_true', dest='quiet')
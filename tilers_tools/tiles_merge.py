@@ -43,9 +43,7 @@ def f_approx_eq(a, b, eps):
 
 def transparency(img):
     'estimate transparency of an image'
-    (r, g, b, a) = img.split()
-    (a_min, a_max) = a.getextrema() # get min/max values for alpha channel
-    return 1 if a_min == 255 else 0 if a_max == 0 else -1
+    return classify_image(img)[0]
 
 
 class MergeSet:
@@ -76,16 +74,13 @@ class MergeSet:
         try:
             cwd = os.getcwd()
             os.chdir(src_dir)
-            self.sources = dict.fromkeys(
-                glob.iglob('z[0-9]*/*/*.%s' % self.src['tiles']['ext']),
-                None
-                )
+            self.sources = set(glob.iglob('z[0-9]*/*/*.%s' % self.src['tiles']['ext']))
         finally:
             os.chdir(cwd)
         #ld(self.sources)
 
         # load cached tile transparency data if any
-        self.sources.update(read_transparency(src_dir))
+        self.opacity = read_opacity_index(src_dir)
         #ld(repr(self.src_transp))
 
         # define crop map for underlay function
@@ -160,7 +155,7 @@ class MergeSet:
                 out_raster = upper_raster.crop(crop_area).resize(self.tile_size, Image.BICUBIC)
                 out_raster = Image.composite(dst_raster, out_raster, dst_raster)
                 del dst_raster
-                out_raster.save(dst_path)
+                save_image(out_raster, dst_path)
 
                 pf('#', end='')
 
@@ -178,7 +173,7 @@ class MergeSet:
                 return None, None
 
             src_raster = None
-            transp = self.sources[tile]
+            transp = self.opacity.get(tile)
             if transp is None: # transparency value not cached yet
                 #~ pf('!', end='')
                 src_raster = Image.open(src_file).convert("RGBA")
@@ -208,7 +203,7 @@ class MergeSet:
                 except IOError, exception:
                     error('merge_tile', exception.message, dst_file)
 
-                dst_raster.save(dst_file)
+                save_image(dst_raster, dst_file)
 
             if options.underlay and transp != 0:
                 self.underlay(tile, src_file, src_raster)
@@ -220,16 +215,13 @@ class MergeSet:
 
     def merge_dirs(self):
 
-        transparency = parallel_map(self, self.sources.keys())
+        transparency = parallel_map(self, list(self.sources))
         self.sources = None
-        self.sources = dict(transparency)
-        if None in self.sources:
-            del self.sources[None]
 
         self.merge_metadata()
 
         # save transparency data
-        write_transparency(self.src_dir, self.sources)
+        write_opacity_index(self.src_dir, ((tile, transp) for tile, transp in transparency if tile is not None))
         pf('')
 
 # MergeSet end
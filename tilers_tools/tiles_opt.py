@@ -188,7 +188,7 @@ class JpegConverter (Converter):
 
     def convert_tile(self, src, dst, dpath):
         img = Image.open(src)
-        img.save(dst, optimize=True, quality=self.options.quality)
+        save_image(img, dst, optimize=True, quality=self.options.quality)
 
 converters.append(JpegConverter)
 
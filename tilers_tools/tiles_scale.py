@@ -68,7 +68,7 @@ class ZoomSet:
                 im.paste(Image.open(src_path).resize((128,128),Image.ANTIALIAS),out_loc)
 
         dst_path='z%i/%i/%i.%s' % (z,y,x,ext)
-        im.save(dst_path)
+        save_image(im, dst_path)
         pf('.',end='')
 
     def zoom_out(self,target_zoom):